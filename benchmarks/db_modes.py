@@ -0,0 +1,92 @@
+# Compare requests/sec of the sync and the async database mode.
+#
+# Each mode runs in its own process, since the mode is chosen when
+# microblog.database is imported. Uses DATABASE_URL if set, otherwise a
+# temporary SQLite database.
+#
+#   python benchmarks/db_modes.py --requests 2000 --concurrency 50
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def seed(posts: int) -> None:
+    from microblog.database import SessionLocal, engine
+    from microblog.models import Base, MicroblogPost, User
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        if db.query(User).count():
+            return
+        user = User(username="bench", email="bench@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        db.add_all(
+            MicroblogPost(author_id=user.id, content=f"Post number {i}")
+            for i in range(posts)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def drive(requests: int, concurrency: int) -> float:
+    import httpx
+    from microblog.app import app
+    from microblog.database import async_engine
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        queue = iter(range(requests))
+
+        async def worker():
+            for _ in queue:
+                response = await client.get("/posts/")
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    if async_engine is not None:
+        await async_engine.dispose()
+    return requests / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        seed(args.posts)
+        print(json.dumps(asyncio.run(drive(args.requests, args.concurrency))))
+        return
+
+    env = dict(os.environ)
+    env.setdefault("SESSION_SECRET_KEY", "benchmark")
+    with tempfile.TemporaryDirectory() as tmp:
+        env.setdefault("DATABASE_URL", f"sqlite:///{tmp}/bench.sqlite")
+        for mode in ("false", "true"):
+            output = subprocess.run(
+                [sys.executable, __file__, "--worker", *sys.argv[1:]],
+                env=dict(env, DATABASE_ASYNC=mode),
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            name = "async" if mode == "true" else "sync"
+            print(f"{name:>5}: {float(output.splitlines()[-1]):8.1f} requests/sec")
+
+
+if __name__ == "__main__":
+    main()
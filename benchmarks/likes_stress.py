@@ -0,0 +1,132 @@
+# Hammer likes and unlikes of a few posts from many threads at once.
+#
+# Every thread repeatedly likes, unlikes, toggles and batch-changes the
+# likes of a small set of users on a small set of posts, so the same
+# (post, user) pair is changed concurrently all the time, like a form
+# that is submitted twice. Afterwards there must be no duplicate likes
+# and every post's like_count must equal its number of likes. The same
+# check runs on SQLite in tests/test_likes.py, this script adds load and
+# can run it against PostgreSQL.
+# Uses DATABASE_URL if set (the database is wiped!), otherwise a
+# temporary SQLite database.
+#
+#   python benchmarks/likes_stress.py --threads 16 --operations 500
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def seed(engine, users: int, posts: int) -> None:
+    from microblog.models import Base, MicroblogPost, User
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": "-"}
+            for i in range(1, users + 1)
+        ])
+        connection.execute(MicroblogPost.__table__.insert(), [
+            {"id": i, "author_id": 1, "content": f"Post {i}"}
+            for i in range(1, posts + 1)
+        ])
+
+
+def hammer(users: int, posts: int, operations: int, seed: int, errors: list) -> None:
+    from microblog.database import SessionLocal
+    from microblog.likes import ACTIONS, change_like, change_likes
+
+    rng = random.Random(seed)
+    db = SessionLocal()
+    try:
+        for _ in range(operations):
+            user_id = rng.randint(1, users)
+            if rng.random() < 0.1:
+                change_likes(db, user_id, {
+                    rng.randint(1, posts): rng.random() < 0.5 for _ in range(5)
+                })
+            else:
+                change_like(db, user_id, rng.randint(1, posts), rng.choice(ACTIONS))
+    except Exception as error:
+        errors.append(error)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def check(engine) -> list:
+    """Problems found in the likes table and the like counters"""
+    from sqlalchemy import func, select
+
+    from microblog.models import MicroblogPost, PostLike
+
+    problems = []
+    with engine.connect() as connection:
+        duplicates = connection.execute(
+            select(PostLike.post_id, PostLike.user_id, func.count())
+            .group_by(PostLike.post_id, PostLike.user_id)
+            .having(func.count() > 1)
+        ).all()
+        for post_id, user_id, count in duplicates:
+            problems.append(f"post {post_id} liked {count} times by user {user_id}")
+
+        actual = (
+            select(func.count(PostLike.id))
+            .where(PostLike.post_id == MicroblogPost.id)
+            .scalar_subquery()
+        )
+        drifted = connection.execute(
+            select(MicroblogPost.id, MicroblogPost.like_count, actual)
+            .where(MicroblogPost.like_count != actual)
+        ).all()
+        for post_id, like_count, count in drifted:
+            problems.append(f"post {post_id} has like_count {like_count} but {count} likes")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--operations", type=int, default=500, help="Operations per thread")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--posts", type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/likes.sqlite")
+    os.environ.setdefault("DATABASE_POOL_SIZE", str(args.threads))
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+    from microblog.database import engine
+
+    seed(engine, args.users, args.posts)
+    errors = []
+    threads = [
+        threading.Thread(target=hammer, args=(args.users, args.posts, args.operations, i, errors))
+        for i in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = args.threads * args.operations
+    print(f"{total} operations in {elapsed:.1f}s ({total / elapsed:.0f}/s)")
+    problems = [f"{type(error).__name__}: {error}" for error in errors] + check(engine)
+    engine.dispose()
+    tmp.cleanup()
+    for problem in problems:
+        print(f"FAILED {problem}")
+    if problems:
+        sys.exit(1)
+    print("No duplicate likes, all like counts match")
+
+
+if __name__ == "__main__":
+    main()
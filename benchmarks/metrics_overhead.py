@@ -0,0 +1,64 @@
+# Measure the cost of the metrics middleware and instrumentation.
+#
+# Runs the db_modes.py load against the front page with METRICS_ENABLED
+# off and on, each in its own process, and fails when the metrics cost
+# more than --budget of the throughput.
+#
+#   python benchmarks/metrics_overhead.py --requests 2000 --budget 0.05
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from db_modes import drive, seed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--budget", type=float, default=0.05,
+        help="Largest accepted drop in requests/sec, as a fraction"
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        seed(args.posts)
+        print(json.dumps(asyncio.run(drive(args.requests, args.concurrency))))
+        return
+
+    env = dict(os.environ)
+    env.setdefault("SESSION_SECRET_KEY", "benchmark")
+    results = {"false": [], "true": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        env.setdefault("DATABASE_URL", f"sqlite:///{tmp}/bench.sqlite")
+        # Alternate the modes, so drift affects both alike
+        for _ in range(args.rounds):
+            for enabled in results:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--worker", *sys.argv[1:]],
+                    env=dict(env, METRICS_ENABLED=enabled),
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+                results[enabled].append(float(output.splitlines()[-1]))
+
+    without, with_metrics = max(results["false"]), max(results["true"])
+    overhead = 1 - with_metrics / without
+    print(f"without metrics: {without:8.1f} requests/sec")
+    print(f"   with metrics: {with_metrics:8.1f} requests/sec")
+    print(f"       overhead: {overhead:8.1%} (budget {args.budget:.1%})")
+    if overhead > args.budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Measure the overhead of rate limiting and admission control per request.
+#
+# Calls the middleware directly around an app that answers right away,
+# so only the middleware is timed: route matching, the session cookie
+# lookup and taking a token from the memory or SQLite backend. Requests
+# come from --clients IP addresses and users, with budgets large enough
+# that none is refused.
+#
+#   python benchmarks/ratelimit.py --requests 100000
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("SESSION_SECRET_KEY", "benchmark")
+
+
+async def ok(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send(message):
+    if message["type"] == "http.response.start" and message["status"] != 200:
+        raise RuntimeError(f"Request refused with {message['status']}")
+
+
+def scopes(requests: int, clients: int, logged_in: bool) -> list:
+    from microblog.routers.auth import create_session_token, verified_sessions
+    from microblog.timeline import UserSummary
+
+    headers = []
+    for i in range(clients):
+        if logged_in:
+            token = create_session_token(i, f"user{i}")
+            verified_sessions.set(token, UserSummary(i, f"user{i}"))
+            headers.append([(b"cookie", f"session_token={token}".encode())])
+        else:
+            headers.append([])
+    return [
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/posts/",
+            "headers": headers[i % clients],
+            "client": (f"10.0.{i % clients // 256}.{i % 256}", 50000),
+        }
+        for i in range(requests)
+    ]
+
+
+async def timed(app, requests: list) -> float:
+    """Microseconds per request"""
+    start = time.perf_counter()
+    for scope in requests:
+        await app(scope, None, send)
+    return (time.perf_counter() - start) / len(requests) * 1e6
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=1000)
+    args = parser.parse_args()
+
+    from microblog.ratelimit import (
+        AdmissionControlMiddleware,
+        MemoryRateLimitStore,
+        RateLimitMiddleware,
+        SQLiteRateLimitStore,
+    )
+
+    budgets = {"timeline": (1e9, 1e9)}
+    anonymous = scopes(args.requests, args.clients, logged_in=False)
+    logged_in = scopes(args.requests, args.clients, logged_in=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_store = SQLiteRateLimitStore(os.path.join(tmp, "limits.db"))
+        cases = [
+            ("no middleware", ok, anonymous),
+            ("admission control", AdmissionControlMiddleware(ok, 100, 100, 1), anonymous),
+            ("memory, per IP", RateLimitMiddleware(ok, MemoryRateLimitStore(100000), budgets), anonymous),
+            ("memory, per user", RateLimitMiddleware(ok, MemoryRateLimitStore(100000), budgets), logged_in),
+            ("sqlite, per IP", RateLimitMiddleware(ok, sqlite_store, budgets), anonymous),
+        ]
+        baseline = None
+        for name, app, requests in cases:
+            # Warm up: create the buckets
+            await timed(app, requests[:args.clients])
+            micros = await timed(app, requests)
+            if baseline is None:
+                baseline = micros
+            print(f"{name:>18}: {micros:6.1f}us per request ({micros - baseline:+.1f}us)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
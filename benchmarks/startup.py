@@ -0,0 +1,99 @@
+# Measure how long a new worker takes to serve its first request.
+#
+# Each round starts a fresh process that imports microblog.app, runs the
+# lifespan startup and sends GET /posts/ through an in-process ASGI
+# client, timing the three steps. Rounds are run with an empty template
+# bytecode cache ("cold") and with one filled by
+# `microblog compile-templates` ("precompiled"). Uses DATABASE_URL if set,
+# otherwise a temporary SQLite database.
+#
+#   python benchmarks/startup.py --rounds 5
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+async def first_request() -> dict:
+    start = time.perf_counter()
+    import httpx
+    from microblog.app import app
+    imported = time.perf_counter()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async with app.router.lifespan_context(app):
+            started = time.perf_counter()
+            response = await client.get("/posts/")
+            response.raise_for_status()
+            answered = time.perf_counter()
+
+    return {
+        "import": imported - start,
+        "startup": started - imported,
+        "first_request": answered - started,
+        "total": answered - start,
+    }
+
+
+def seed() -> None:
+    """Create the tables and the admin user, as a deployed database has"""
+    from microblog.app import create_admin_user_in_session
+    from microblog.database import engine
+    from microblog.models import Base
+
+    Base.metadata.create_all(engine)
+    create_admin_user_in_session()
+
+
+def run(args: list, env: dict) -> str:
+    return subprocess.run(
+        [sys.executable, *args], env=env, capture_output=True, text=True, check=True
+    ).stdout
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--seed", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed()
+        return
+    if args.worker:
+        print(json.dumps(asyncio.run(first_request())))
+        return
+
+    env = dict(os.environ)
+    env.setdefault("SESSION_SECRET_KEY", "benchmark")
+    results = {"cold": [], "precompiled": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        env.setdefault("DATABASE_URL", f"sqlite:///{tmp}/bench.sqlite")
+        run([__file__, "--seed"], env)
+        for round_ in range(args.rounds):
+            for mode in results:
+                cache_dir = os.path.join(tmp, f"templates-{mode}-{round_}")
+                mode_env = dict(env, TEMPLATE_CACHE_DIR=cache_dir)
+                if mode == "precompiled":
+                    run(["-m", "microblog.cli", "compile-templates"], mode_env)
+                output = run([__file__, "--worker"], mode_env)
+                results[mode].append(json.loads(output.splitlines()[-1]))
+
+    print(f"{'':>12} {'import':>9} {'startup':>9} {'1st req':>9} {'total':>9}  (median)")
+    for mode, rounds in results.items():
+        medians = [
+            statistics.median(result[step] for result in rounds) * 1000
+            for step in ("import", "startup", "first_request", "total")
+        ]
+        print(f"{mode:>12} " + " ".join(f"{median:>7.1f}ms" for median in medians))
+
+
+if __name__ == "__main__":
+    main()
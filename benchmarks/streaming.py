@@ -0,0 +1,139 @@
+# Compare time to first byte, total time and peak memory of the front
+# page rendered in one piece and streamed (STREAMING_RENDER).
+#
+# Peak memory includes the rendered post fragments added to the fragment
+# cache, which is bounded by FRAGMENT_CACHE_SIZE.
+#
+# Each mode runs in its own process, since the mode is read when the app
+# is imported. Uses DATABASE_URL if set (the database is wiped!),
+# otherwise a temporary SQLite database.
+#
+#   python benchmarks/streaming.py --posts 20000 --limits 100,1000
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+
+def seed(engine, posts: int) -> None:
+    from microblog.models import Base, MicroblogPost, User
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    start = datetime.now(timezone.utc) - timedelta(seconds=posts)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"id": 1, "username": "bench", "email": "bench@example.com", "hashed_password": "x"}
+        ])
+        connection.execute(MicroblogPost.__table__.insert(), [
+            {
+                "author_id": 1,
+                "content": f"Post number {i} " + "lorem ipsum " * 20,
+                "created_at": start + timedelta(seconds=i),
+            }
+            for i in range(posts)
+        ])
+
+
+async def request(app, path: str, query: str) -> dict:
+    """Call the ASGI app directly, recording when body chunks arrive"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "", "headers": [],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+    chunks = []
+    disconnected = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client stays connected until the response is complete
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            raise RuntimeError(f"{path}?{query}: {message['status']}")
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append((time.perf_counter(), len(message["body"])))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "first_byte_ms": (chunks[0][0] - start) * 1000,
+        "total_ms": (chunks[-1][0] - start) * 1000,
+        "chunks": len(chunks),
+        "bytes": sum(size for _, size in chunks),
+        "peak_kb": peak / 1024,
+    }
+
+
+def worker(limit: int) -> dict:
+    from microblog.app import app
+
+    # Warm up templates and connections
+    asyncio.run(request(app, "/posts/", "limit=10"))
+    return asyncio.run(request(app, "/posts/", f"limit={limit}"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--limits", default="100,1000")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(args.worker)))
+        return
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/bench.sqlite")
+    os.environ.setdefault("SESSION_SECRET_KEY", "benchmark")
+    src = os.path.join(os.path.dirname(__file__), "..", "src")
+    sys.path.insert(0, src)
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [src, os.getenv("PYTHONPATH")]))
+
+    from microblog.database import engine
+    seed(engine, args.posts)
+
+    print(f"{'mode':>9} {'limit':>6} {'first byte':>11} {'total':>10} {'chunks':>7} {'peak memory':>12}")
+    for limit in (int(limit) for limit in args.limits.split(",")):
+        for streaming in ("false", "true"):
+            completed = subprocess.run(
+                [sys.executable, __file__, "--worker", str(limit)],
+                env=dict(os.environ, STREAMING_RENDER=streaming),
+                capture_output=True,
+                text=True,
+            )
+            mode = "streamed" if streaming == "true" else "buffered"
+            if completed.returncode != 0:
+                # The buffered mode only allows pages up to MAX_PAGE_SIZE
+                print(f"{mode:>9} {limit:>6} {'-':>11}")
+                continue
+            result = json.loads(completed.stdout.splitlines()[-1])
+            print(
+                f"{mode:>9} {limit:>6} {result['first_byte_ms']:>9.1f}ms"
+                f" {result['total_ms']:>8.1f}ms {result['chunks']:>7}"
+                f" {result['peak_kb']:>10.0f}kB"
+            )
+
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
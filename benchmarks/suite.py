@@ -0,0 +1,270 @@
+# Benchmark the read and write hot paths through the ASGI app.
+#
+# Seeds a database with users, posts, replies and likes, then runs each
+# scenario with concurrent requests through an in-process ASGI client and
+# reports latency percentiles, throughput and SQL statements per request.
+# Uses DATABASE_URL if set (the database is wiped!), otherwise a
+# temporary SQLite database.
+#
+#   python benchmarks/suite.py --save-baseline   # record benchmarks/baseline.json
+#   python benchmarks/suite.py                   # compare against it
+#
+# Exits with an error when a scenario regresses by more than --tolerance
+# compared to the baseline: higher p95 latency, lower throughput or more
+# SQL statements per request.
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+
+PASSWORD = "benchmark"
+
+# Statements executed by the request being timed
+statement_count: ContextVar[list] = ContextVar("statement_count")
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = statement_count.get(None)
+    if counter is not None:
+        counter[0] += 1
+
+
+def seed(engine, users: int, posts: int, replies: float, likes: int) -> None:
+    from microblog.counters import reconcile_counters
+    from microblog.database import SessionLocal
+    from microblog.fanout import rebuild_timelines
+    from microblog.models import Base, MicroblogPost, PostLike, User
+    from microblog.passwords import hash_password
+
+    rng = random.Random(0)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    hashed_password = hash_password(PASSWORD)
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    step = timedelta(days=30) / max(posts, 1)
+
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {
+                "id": i,
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "hashed_password": hashed_password,
+            }
+            for i in range(1, users + 1)
+        ])
+
+        authors = {}
+        for offset in range(0, posts, 10000):
+            rows = []
+            for post_id in range(offset + 1, min(offset + 10000, posts) + 1):
+                author_id = rng.randint(1, users)
+                row = {
+                    "id": post_id,
+                    "author_id": author_id,
+                    "content": f"Post number {post_id} " + "lorem ipsum " * rng.randint(1, 20),
+                    "created_at": start + step * post_id,
+                    "in_reply_to_post_id": None,
+                    "in_reply_to_user_id": None,
+                }
+                if post_id > 1 and rng.random() < replies:
+                    parent_id = rng.randint(max(1, post_id - 1000), post_id - 1)
+                    row["in_reply_to_post_id"] = parent_id
+                    row["in_reply_to_user_id"] = authors[parent_id]
+                authors[post_id] = author_id
+                rows.append(row)
+            connection.execute(MicroblogPost.__table__.insert(), rows)
+
+        pairs = set()
+        while len(pairs) < min(likes, users * posts):
+            pairs.add((rng.randint(1, posts), rng.randint(1, users)))
+        pairs = list(pairs)
+        for offset in range(0, len(pairs), 10000):
+            connection.execute(PostLike.__table__.insert(), [
+                {"post_id": post_id, "user_id": user_id}
+                for post_id, user_id in pairs[offset:offset + 10000]
+            ])
+
+    db = SessionLocal()
+    try:
+        reconcile_counters(db)
+        rebuild_timelines(db)
+    finally:
+        db.close()
+    with engine.begin() as connection:
+        # Give the query planner statistics for the new data
+        connection.exec_driver_sql("ANALYZE")
+
+
+def scenarios(users: int, posts: int):
+    """name -> function returning (method, url, form data, user id to log in as)"""
+    def user():
+        return random.randint(1, users)
+
+    def post():
+        return random.randint(1, posts)
+
+    return {
+        "view_all_posts": lambda: ("GET", "/posts/", None, user()),
+        "view_single_posts": lambda: ("GET", f"/posts/{post()}", None, user()),
+        "view_users_posts": lambda: ("GET", f"/users/user{user()}", None, user()),
+        "like_post_via_form": lambda: ("POST", "/posts/like", {"post_id": post()}, user()),
+        "create_post_via_form": lambda: (
+            "POST", "/posts/create", {"content": "A new benchmark post"}, user()
+        ),
+        "login": lambda: (
+            "POST", "/auth/login", {"username": f"user{user()}", "password": PASSWORD}, None
+        ),
+    }
+
+
+async def run_scenario(client, make_request, requests: int, concurrency: int) -> dict:
+    from microblog.routers.auth import create_session_token
+
+    latencies = []
+    statements = []
+    queue = iter(range(requests))
+
+    async def worker():
+        for _ in queue:
+            method, url, data, user_id = make_request()
+            headers = {}
+            if user_id is not None:
+                token = create_session_token(user_id, f"user{user_id}")
+                headers["cookie"] = f"session_token={token}"
+            counter = [0]
+            token = statement_count.set(counter)
+            start = time.perf_counter()
+            response = await client.request(method, url, data=data, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            statement_count.reset(token)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{method} {url}: {response.status_code}")
+            statements.append(counter[0])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "requests_per_second": requests / elapsed,
+        "statements_per_request": statistics.mean(statements),
+    }
+
+
+async def run_all(names, users: int, posts: int, requests: int, concurrency: int) -> dict:
+    import httpx
+    from microblog.app import app
+    from microblog.database import async_engine
+
+    available = scenarios(users, posts)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # Startup hooks (admin user, fan-out worker) are run by the lifespan
+        async with app.router.lifespan_context(app):
+            for name in names:
+                results[name] = await run_scenario(
+                    client, available[name], requests, concurrency
+                )
+
+    if async_engine is not None:
+        await async_engine.dispose()
+    return results
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            found.append(f"{name}: p95 {old['p95_ms']:.1f}ms -> {result['p95_ms']:.1f}ms")
+        if result["requests_per_second"] < old["requests_per_second"] * (1 - tolerance):
+            found.append(
+                f"{name}: throughput {old['requests_per_second']:.1f}"
+                f" -> {result['requests_per_second']:.1f} requests/sec"
+            )
+        if result["statements_per_request"] > old["statements_per_request"] * (1 + tolerance):
+            found.append(
+                f"{name}: SQL statements {old['statements_per_request']:.1f}"
+                f" -> {result['statements_per_request']:.1f} per request"
+            )
+    return found
+
+
+def main() -> None:
+    default_baseline = os.path.join(os.path.dirname(__file__), "baseline.json")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--replies", type=float, default=0.3, help="Fraction of posts that are replies")
+    parser.add_argument("--likes", type=int, default=30000)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(scenarios(1, 1)))
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/bench.sqlite")
+    os.environ.setdefault("SESSION_SECRET_KEY", "benchmark")
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+    from sqlalchemy import event
+
+    from microblog.database import async_engine, engine
+
+    seed(engine, args.users, args.posts, args.replies, args.likes)
+    event.listen(engine, "before_cursor_execute", count_statement)
+    if async_engine is not None:
+        event.listen(async_engine.sync_engine, "before_cursor_execute", count_statement)
+
+    names = args.scenarios.split(",")
+    results = asyncio.run(
+        run_all(names, args.users, args.posts, args.requests, args.concurrency)
+    )
+    tmp.cleanup()
+
+    print(f"{'scenario':<22} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8} {'SQL/req':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:<22} {result['p50_ms']:>7.1f}ms {result['p95_ms']:>7.1f}ms"
+            f" {result['p99_ms']:>7.1f}ms {result['requests_per_second']:>8.1f}"
+            f" {result['statements_per_request']:>8.1f}"
+        )
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
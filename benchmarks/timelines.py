@@ -0,0 +1,85 @@
+# Compare front page read latency with and without materialized timelines.
+#
+# Seeds a fresh database per size. Uses DATABASE_URL if set (the database
+# is wiped!), otherwise a temporary SQLite database.
+#
+#   python benchmarks/timelines.py --sizes 10000,100000,1000000
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+
+def seed(engine, posts: int) -> None:
+    from microblog.models import Base, MicroblogPost, User
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    start = datetime.now(timezone.utc) - timedelta(seconds=posts)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"id": 1, "username": "bench", "email": "bench@example.com", "hashed_password": "x"}
+        ])
+        for offset in range(0, posts, 50000):
+            connection.execute(MicroblogPost.__table__.insert(), [
+                {
+                    "author_id": 1,
+                    "content": f"Post number {i}",
+                    "created_at": start + timedelta(seconds=i),
+                    # Every fifth post is a reply
+                    "in_reply_to_post_id": i if i % 5 == 4 else None,
+                }
+                for i in range(offset, min(offset + 50000, posts))
+            ])
+        # Give the query planner statistics for the new data
+        connection.exec_driver_sql("ANALYZE")
+
+
+def measure(load, runs: int) -> float:
+    """Median latency of `load()` in milliseconds"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        load()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/bench.sqlite")
+    os.environ.setdefault("SESSION_SECRET_KEY", "benchmark")
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+    from microblog import fanout
+    from microblog.database import SessionLocal, engine
+
+    print(f"{'posts':>9} {'read-time':>12} {'materialized':>14}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        seed(engine, size)
+        db = SessionLocal()
+        try:
+            fanout.rebuild_timelines(db)
+            results = []
+            for materialized in (False, True):
+                fanout.MATERIALIZED_TIMELINES = materialized
+                results.append(measure(
+                    lambda: fanout.load_global_timeline_page(db, None, 50), args.runs
+                ))
+        finally:
+            db.close()
+        print(f"{size:>9} {results[0]:>10.2f}ms {results[1]:>12.2f}ms")
+
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
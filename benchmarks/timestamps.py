@@ -0,0 +1,106 @@
+# Compare formatting post timestamps one by one with formatting a page
+# of them in one batch.
+#
+# For each page size, times are spread over the last 60 days, so a page
+# has a mix of "N min ago", "Nh ago" and absolute times. Three ways of
+# formatting them are timed:
+#
+# - per post: format_datetime for every post, reading the clock each time
+#   (how timelines were formatted before)
+# - batch: one TimestampFormatter for the page, formatting all its times
+#   in one go, absolute times from the cache
+# - render: the timeline loop of posts.html (format_post_times and
+#   render_post) for a page, as a request renders it
+#
+#   python benchmarks/timestamps.py --sizes 50,500,5000
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("SESSION_SECRET_KEY", "benchmark")
+
+TIMELINE = """
+{{ format_post_times(posts) }}
+{% for post in posts %}{{ render_post(post, user_id_logged_in, user_logged_in) }}{% endfor %}
+"""
+
+
+def make_posts(count: int, rng: random.Random) -> list:
+    from microblog.timeline import TimelinePost
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return [
+        TimelinePost(
+            id=i,
+            author_id=1,
+            author_username="bench",
+            content=f"Post number {i}",
+            created_at=now - timedelta(seconds=rng.randint(0, 60 * 24 * 3600)),
+            in_reply_to_post_id=None,
+            in_reply_to_user_id=None,
+            reply_to_username=None,
+            reply_count=0,
+            like_count=0,
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+def timed(fn, rounds: int) -> float:
+    """Median time of fn() in milliseconds"""
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="50,500,5000")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    from starlette.requests import Request
+
+    from microblog.template_utils import (
+        TimestampFormatter,
+        format_datetime,
+        templates,
+    )
+    from microblog.timeline import UserSummary
+
+    timeline = templates.env.from_string(TIMELINE)
+    viewer = UserSummary(1, "bench")
+    rng = random.Random(0)
+
+    print(f"{'posts':>6} {'per post':>10} {'batch':>10} {'render':>10}  (median)")
+    for size in (int(size) for size in args.sizes.split(",")):
+        posts = make_posts(size, rng)
+        times = [post.created_at for post in posts]
+        # Render once, so fragments and absolute times are cached as on a
+        # busy server
+        timeline.render(posts=posts, request=Request({"type": "http"}))
+
+        per_post = timed(lambda: [format_datetime(dt) for dt in times], args.rounds)
+        batch = timed(lambda: TimestampFormatter().format_all(times), args.rounds)
+        render = timed(
+            lambda: timeline.render(
+                posts=posts,
+                request=Request({"type": "http"}),
+                user_id_logged_in=viewer.id,
+                user_logged_in=viewer,
+            ),
+            args.rounds,
+        )
+        print(f"{size:>6} {per_post:>8.2f}ms {batch:>8.2f}ms {render:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
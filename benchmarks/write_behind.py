@@ -0,0 +1,121 @@
+# Compare writes/sec with and without WRITE_BEHIND.
+#
+# Sends concurrent like (toggle) and create post form requests through an
+# in-process ASGI client, each mode in its own process and database. The
+# time includes committing whatever is still queued at shutdown, and the
+# number of database transactions is reported next to the throughput.
+# Uses a temporary SQLite database per mode, or DATABASE_URL if set (the
+# database is wiped!).
+#
+#   python benchmarks/write_behind.py --requests 2000 --concurrency 50
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def seed(users: int, posts: int) -> None:
+    from microblog.database import engine
+    from microblog.models import Base, MicroblogPost, User
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": "-"}
+            for i in range(1, users + 1)
+        ])
+        connection.execute(MicroblogPost.__table__.insert(), [
+            {"id": i, "author_id": 1, "content": f"Post {i}"}
+            for i in range(1, posts + 1)
+        ])
+
+
+async def drive(requests: int, concurrency: int, users: int, posts: int, creates: float) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    from microblog.app import app
+    from microblog.database import engine
+    from microblog.routers.auth import create_session_token
+
+    commits = [0]
+    event.listen(engine, "commit", lambda conn: commits.__setitem__(0, commits[0] + 1))
+    cookies = {
+        user_id: f"session_token={create_session_token(user_id, f'user{user_id}')}"
+        for user_id in range(1, users + 1)
+    }
+    rng = random.Random(0)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        queue = iter(range(requests))
+
+        async def worker():
+            for _ in queue:
+                headers = {"cookie": cookies[rng.randint(1, users)]}
+                if rng.random() < creates:
+                    data = {"content": "A new benchmark post"}
+                    url = "/posts/create"
+                else:
+                    data = {"post_id": rng.randint(1, posts)}
+                    url = "/posts/like"
+                response = await client.post(url, data=data, headers=headers)
+                if response.status_code != 303:
+                    raise RuntimeError(f"POST {url}: {response.status_code}")
+
+        start = time.perf_counter()
+        # Shutting down commits the writes still queued
+        async with app.router.lifespan_context(app):
+            commits[0] = 0
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {"writes_per_second": requests / elapsed, "transactions": commits[0]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--creates", type=float, default=0.1, help="Fraction of requests that create posts")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        seed(args.users, args.posts)
+        result = asyncio.run(
+            drive(args.requests, args.concurrency, args.users, args.posts, args.creates)
+        )
+        print(json.dumps(result))
+        return
+
+    env = dict(os.environ)
+    env.setdefault("SESSION_SECRET_KEY", "benchmark")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("false", "true"):
+            mode_env = dict(env, WRITE_BEHIND=mode)
+            mode_env.setdefault("DATABASE_URL", f"sqlite:///{tmp}/bench-{mode}.sqlite")
+            output = subprocess.run(
+                [sys.executable, __file__, "--worker", *sys.argv[1:]],
+                env=mode_env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            name = "write-behind" if mode == "true" else "direct"
+            print(
+                f"{name:>12}: {result['writes_per_second']:8.1f} writes/sec"
+                f" in {result['transactions']} transactions"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Add like and reply counters to posts
+
+Revision ID: 7c720a5f856a
+Revises: 9969bc8e0315
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c720a5f856a'
+down_revision: Union[str, Sequence[str], None] = '9969bc8e0315'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('microblog_posts', sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('microblog_posts', sa.Column('reply_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill counters from the existing likes and replies
+    op.execute(
+        """
+        UPDATE microblog_posts SET
+            like_count = (
+                SELECT count(*) FROM microblog_likes
+                WHERE microblog_likes.post_id = microblog_posts.id
+            ),
+            reply_count = (
+                SELECT count(*) FROM microblog_posts AS replies
+                WHERE replies.in_reply_to_post_id = microblog_posts.id
+            )
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('microblog_posts', 'reply_count')
+    op.drop_column('microblog_posts', 'like_count')
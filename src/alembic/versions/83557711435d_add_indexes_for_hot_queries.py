@@ -0,0 +1,96 @@
+"""Add indexes for timeline, profile, reply and like queries
+
+Revision ID: 83557711435d
+Revises: 7c720a5f856a
+Create Date: 2026-10-18 11:03:27.918042
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '83557711435d'
+down_revision: Union[str, Sequence[str], None] = '7c720a5f856a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def create_indexes() -> None:
+    # Front page timeline: top-level posts, newest first
+    op.create_index(
+        'ix_microblog_posts_timeline',
+        'microblog_posts',
+        [sa.text('created_at DESC'), sa.text('id DESC')],
+        postgresql_where=sa.text('in_reply_to_post_id IS NULL'),
+        sqlite_where=sa.text('in_reply_to_post_id IS NULL'),
+        postgresql_concurrently=True,
+    )
+    # Profile timeline: one author's posts, newest first
+    op.create_index(
+        'ix_microblog_posts_author_id_created_at',
+        'microblog_posts',
+        ['author_id', sa.text('created_at DESC'), sa.text('id DESC')],
+        postgresql_concurrently=True,
+    )
+    # Replies to a post
+    op.create_index(
+        'ix_microblog_posts_in_reply_to_post_id',
+        'microblog_posts',
+        ['in_reply_to_post_id'],
+        postgresql_concurrently=True,
+    )
+    # Like toggling, and at most one like per user and post
+    op.create_index(
+        'uq_microblog_likes_post_id_user_id',
+        'microblog_likes',
+        ['post_id', 'user_id'],
+        unique=True,
+        postgresql_concurrently=True,
+    )
+
+
+def drop_indexes() -> None:
+    op.drop_index('uq_microblog_likes_post_id_user_id', table_name='microblog_likes', postgresql_concurrently=True)
+    op.drop_index('ix_microblog_posts_in_reply_to_post_id', table_name='microblog_posts', postgresql_concurrently=True)
+    op.drop_index('ix_microblog_posts_author_id_created_at', table_name='microblog_posts', postgresql_concurrently=True)
+    op.drop_index('ix_microblog_posts_timeline', table_name='microblog_posts', postgresql_concurrently=True)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Duplicate likes must go before the unique index can be built
+    op.execute(
+        """
+        DELETE FROM microblog_likes WHERE id NOT IN (
+            SELECT min(id) FROM microblog_likes GROUP BY post_id, user_id
+        )
+        """
+    )
+    op.execute(
+        """
+        UPDATE microblog_posts SET like_count = (
+            SELECT count(*) FROM microblog_likes
+            WHERE microblog_likes.post_id = microblog_posts.id
+        )
+        """
+    )
+
+    # On Postgres, build indexes without locking the tables for writes.
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction.
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            create_indexes()
+    else:
+        create_indexes()
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            drop_indexes()
+    else:
+        drop_indexes()
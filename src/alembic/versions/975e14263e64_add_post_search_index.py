@@ -0,0 +1,62 @@
+"""Add full-text search index for posts
+
+Revision ID: 975e14263e64
+Revises: d57b74162928
+Create Date: 2026-10-18 15:22:48.104367
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '975e14263e64'
+down_revision: Union[str, Sequence[str], None] = 'd57b74162928'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        # Filled in when searching, see microblog/search.py
+        op.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS microblog_posts_fts "
+            "USING fts5(content, content='')"
+        )
+        return
+
+    op.add_column('microblog_posts', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed("to_tsvector('simple', content)", persisted=True),
+    ))
+    # The GIN pending list (fastupdate) batches index updates, so new
+    # posts do not pay for updating the index when they are inserted
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_microblog_posts_search_vector',
+            'microblog_posts',
+            ['search_vector'],
+            postgresql_using='gin',
+            postgresql_with={'fastupdate': 'on'},
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        op.execute("DROP TABLE IF EXISTS microblog_posts_fts")
+        return
+
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_microblog_posts_search_vector',
+            table_name='microblog_posts',
+            postgresql_concurrently=True,
+        )
+    op.drop_column('microblog_posts', 'search_vector')
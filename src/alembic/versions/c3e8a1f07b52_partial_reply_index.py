@@ -0,0 +1,57 @@
+"""Only index posts that are replies in the reply index
+
+Revision ID: c3e8a1f07b52
+Revises: 4b1f0c9e2a7d
+Create Date: 2026-10-19 09:12:40.381920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3e8a1f07b52'
+down_revision: Union[str, Sequence[str], None] = '4b1f0c9e2a7d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def replace_reply_index(**where) -> None:
+    op.drop_index(
+        'ix_microblog_posts_in_reply_to_post_id',
+        table_name='microblog_posts',
+        postgresql_concurrently=True,
+    )
+    op.create_index(
+        'ix_microblog_posts_in_reply_to_post_id',
+        'microblog_posts',
+        ['in_reply_to_post_id'],
+        postgresql_concurrently=True,
+        **where,
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The front page filters on in_reply_to_post_id IS NULL. With every
+    # post in the reply index, the planner could pick it for that filter
+    # and sort all top-level posts, instead of reading the timeline index
+    # in order. Reply lookups (in_reply_to_post_id = ?) imply IS NOT NULL,
+    # so they can still use the partial index.
+    where = sa.text('in_reply_to_post_id IS NOT NULL')
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            replace_reply_index(postgresql_where=where)
+    else:
+        replace_reply_index(sqlite_where=where)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            replace_reply_index()
+    else:
+        replace_reply_index()
@@ -0,0 +1,51 @@
+"""Add materialized timeline entries
+
+Revision ID: d57b74162928
+Revises: 83557711435d
+Create Date: 2026-10-18 13:40:09.551274
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd57b74162928'
+down_revision: Union[str, Sequence[str], None] = '83557711435d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('timeline_entries',
+    sa.Column('timeline_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['microblog_posts.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('timeline_id', 'post_id')
+    )
+    op.create_index(
+        'ix_timeline_entries_timeline',
+        'timeline_entries',
+        ['timeline_id', sa.text('created_at DESC'), sa.text('post_id DESC')],
+    )
+
+    # Backfill the front page timeline (id 0) with the newest posts
+    op.execute(
+        """
+        INSERT INTO timeline_entries (timeline_id, post_id, created_at)
+        SELECT 0, id, created_at FROM microblog_posts
+        WHERE in_reply_to_post_id IS NULL AND created_at IS NOT NULL
+        ORDER BY created_at DESC, id DESC
+        LIMIT 800
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_timeline_entries_timeline', table_name='timeline_entries')
+    op.drop_table('timeline_entries')
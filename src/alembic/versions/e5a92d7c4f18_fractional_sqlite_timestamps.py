@@ -0,0 +1,44 @@
+"""Store post timestamps on SQLite with microseconds
+
+Revision ID: e5a92d7c4f18
+Revises: c3e8a1f07b52
+Create Date: 2026-10-19 10:02:17.554013
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a92d7c4f18'
+down_revision: Union[str, Sequence[str], None] = 'c3e8a1f07b52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Columns compared against pagination cursors
+COLUMNS = [('microblog_posts', 'created_at'), ('timeline_entries', 'created_at')]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # SQLite stores timestamps as text, and its CURRENT_TIMESTAMP default
+    # has no fraction of a second ('2024-01-01 12:00:00'). Cursors are
+    # bound with one ('2024-01-01 12:00:00.000000'), so as text, posts of
+    # the same second sorted before the cursor and pages repeated. New
+    # rows get their timestamp from the app (models.utcnow) with the
+    # fraction, bring the existing ones in line.
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table, column in COLUMNS:
+        op.execute(
+            f"UPDATE {table} SET {column} = {column} || '.000000' "
+            f"WHERE length({column}) = 19"
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # The longer format is what the app writes from now on, and older
+    # versions read it just as well
+    pass
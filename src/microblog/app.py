@@ -1,38 +1,116 @@
 # FastAPI application for a microblogging service
 import os
+from contextlib import asynccontextmanager
+
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from passlib.hash import bcrypt
+from starlette.concurrency import run_in_threadpool
 
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 
-from .database import SessionLocal
+from .database import (
+    DATABASE_REPLICA_URLS, SessionLocal, StickyPrimaryMiddleware, async_engine, engine,
+    replica_pool
+)
+from .events import EVENTS_POSTGRES_BRIDGE, event_bus
+from .fanout import MATERIALIZED_TIMELINES, fanout_worker
+from .metrics import (
+    METRICS_ENABLED, MetricsMiddleware, instrument_engine, instrument_templates, render_metrics
+)
 from .models import User
-from .routers import auth, posts, users
+from .passwords import hash_password, password_hasher
+from .profiler import PROFILE_REQUESTS, ProfilerMiddleware, profile_engine
+from .ratelimit import (
+    ADMISSION_CONTROL, RATE_LIMITING, AdmissionControlMiddleware, RateLimitMiddleware
+)
+from .routers import admin, api, auth, posts, users
+from .routers.auth import ADMIN_USERNAME
+from .template_utils import templates
+from .writes import WRITE_BEHIND, write_behind
 
-app = FastAPI()
 
-@app.on_event("startup")
-def create_admin_user():
+def create_admin_user(db: Session) -> None:
+    """Create the admin user, unless it exists already"""
+    if db.query(User.id).filter(User.username == ADMIN_USERNAME).first():
+        return
+    password = os.getenv("MICROBLOG_ADMIN_PASSWORD", "password")
+    db.add(User(
+        username=ADMIN_USERNAME,
+        email="admin@example.com",
+        hashed_password=hash_password(password)
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Created by another worker starting at the same time
+        db.rollback()
+
+
+def create_admin_user_in_session() -> None:
     db: Session = SessionLocal()
-    username = os.getenv("MICROBLOG_ADMIN_USERNAME", "admin")
     try:
-        existing = db.query(User).filter(User.username == username).first()
-        if not existing:
-            password = os.getenv("MICROBLOG_ADMIN_PASSWORD", "password")
-
-            hashed = bcrypt.hash(password)
-            admin = User(
-                username=username,
-                email="admin@example.com",
-                hashed_password=hashed
-            )
-            db.add(admin)
-            db.commit()
+        create_admin_user(db)
     finally:
         db.close()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # In the threadpool, a worker starting up keeps the event loop free
+    await run_in_threadpool(create_admin_user_in_session)
+    if MATERIALIZED_TIMELINES:
+        fanout_worker.start()
+    if WRITE_BEHIND:
+        write_behind.start()
+    await run_in_threadpool(replica_pool.start_health_checks)
+    if EVENTS_POSTGRES_BRIDGE:
+        event_bus.start_bridge()
+
+    yield
+
+    event_bus.stop_bridge()
+    await write_behind.stop()
+    await fanout_worker.stop()
+    if async_engine is not None:
+        await async_engine.dispose()
+    replica_pool.stop_health_checks()
+    await replica_pool.dispose()
+    password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Middleware added last runs first: over-budget clients are turned away
+# before they take one of the admitted slots
+if ADMISSION_CONTROL:
+    app.add_middleware(AdmissionControlMiddleware)
+if RATE_LIMITING:
+    app.add_middleware(RateLimitMiddleware)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    instrument_engine(engine, "sync")
+    if async_engine is not None:
+        instrument_engine(async_engine.sync_engine, "async")
+    instrument_templates(templates.env)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        return PlainTextResponse(
+            render_metrics(), media_type="text/plain; version=0.0.4"
+        )
+
+if DATABASE_REPLICA_URLS:
+    app.add_middleware(StickyPrimaryMiddleware)
+
+if PROFILE_REQUESTS:
+    app.add_middleware(ProfilerMiddleware)
+    profile_engine(engine)
+    if async_engine is not None:
+        profile_engine(async_engine.sync_engine)
+
 static_path = os.path.join(
     os.path.dirname(__file__), 'static'
 )
@@ -44,6 +122,8 @@ async def read_root(request: Request):
     return RedirectResponse('/posts')
 
 # Include routers
+app.include_router(admin, prefix="/admin", tags=["admin"])
+app.include_router(api, prefix="/api/v1", tags=["api"])
 app.include_router(auth, prefix="/auth", tags=["auth"])
 app.include_router(posts, prefix="/posts", tags=["posts"])
 app.include_router(users, prefix="/users", tags=["users"])
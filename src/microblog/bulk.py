@@ -0,0 +1,262 @@
+# bulk.py
+#
+# Streaming import and export of users, posts and likes, for seeding
+# staging databases. Each table is one file in a directory, named after
+# the table: users.ndjson, microblog_posts.ndjson, microblog_likes.ndjson
+# (or .csv). Rows are handled in batches, so memory use does not grow
+# with the size of the files.
+#
+# Imported users and posts keep their ids, shifted past the largest id
+# already in the database. Shifting every id by the same amount keeps
+# authors, reply links and likes pointing at the right rows without
+# keeping a map of old to new ids. Likes get new ids.
+import csv
+import io
+import itertools
+import json
+import os
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from sqlalchemy import DateTime, Integer, Table, func, select
+from sqlalchemy.engine import Connection
+
+from .models import MicroblogPost, PostLike, User
+
+# In import order, referenced tables first
+TABLES: List[Table] = [User.__table__, MicroblogPost.__table__, PostLike.__table__]
+
+# Columns holding ids of each table
+ID_COLUMNS = {
+    "users": {"id": "users"},
+    "microblog_posts": {
+        "id": "microblog_posts",
+        "author_id": "users",
+        "in_reply_to_post_id": "microblog_posts",
+        "in_reply_to_user_id": "users",
+    },
+    "microblog_likes": {"post_id": "microblog_posts", "user_id": "users"},
+}
+
+# Tables whose rows are imported without their id
+NEW_IDS = {"microblog_likes"}
+
+FORMATS = ("ndjson", "csv")
+
+Progress = Callable[[str, int], None]
+
+
+def table_path(directory: str, table: Table, fmt: str) -> str:
+    return os.path.join(directory, f"{table.name}.{fmt}")
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_table(
+    connection: Connection,
+    table: Table,
+    out,
+    fmt: str,
+    batch_size: int,
+    progress: Progress,
+) -> int:
+    """Write all rows of `table` to the file `out`, return the row count"""
+    names = [column.name for column in table.columns]
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(names)
+
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+        select(table).order_by(table.c.id)
+    )
+    rows = 0
+    for batch in result.partitions():
+        for row in batch:
+            values = [encode_value(value) for value in row]
+            if writer is not None:
+                writer.writerow(values)
+            else:
+                out.write(json.dumps(dict(zip(names, values))) + "\n")
+        rows += len(batch)
+        progress(table.name, rows)
+    return rows
+
+
+def export_database(
+    connection: Connection, directory: str, fmt: str, batch_size: int, progress: Progress
+) -> Dict[str, int]:
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table in TABLES:
+        with open(table_path(directory, table, fmt), "w", newline="") as out:
+            counts[table.name] = export_table(
+                connection, table, out, fmt, batch_size, progress
+            )
+    return counts
+
+
+def read_rows(file, fmt: str) -> Iterator[dict]:
+    if fmt == "csv":
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def decode_value(column, value):
+    if value is None or (value == "" and column.nullable):
+        return None
+    if isinstance(column.type, Integer):
+        return int(value)
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def prepare_rows(
+    table: Table, rows: Iterable[dict], offsets: Dict[str, int]
+) -> Iterator[dict]:
+    """Decode imported rows and shift their ids"""
+    columns = [
+        column for column in table.columns
+        if not (column.name == "id" and table.name in NEW_IDS)
+    ]
+    id_columns = ID_COLUMNS[table.name]
+    for row in rows:
+        prepared = {}
+        for column in columns:
+            if column.name not in row:
+                continue
+            value = decode_value(column, row[column.name])
+            if value is not None and column.name in id_columns:
+                value += offsets[id_columns[column.name]]
+            prepared[column.name] = value
+        yield prepared
+
+
+def batches(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class IterFile:
+    """Read-only file over an iterator of strings, for COPY ... FROM STDIN"""
+
+    def __init__(self, chunks: Iterable[str]):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def copy_rows(
+    connection: Connection,
+    table: Table,
+    rows: Iterable[dict],
+    batch_size: int,
+    progress: Progress,
+) -> int:
+    """Load rows with COPY FROM STDIN (PostgreSQL)"""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    names = list(first)
+    # Unquoted empty fields are NULL, except in these columns
+    not_null = [
+        column.name for column in table.columns
+        if column.name in names and not column.nullable
+        and not isinstance(column.type, (Integer, DateTime))
+    ]
+    options = "FORMAT csv"
+    if not_null:
+        options += f", FORCE_NOT_NULL ({', '.join(not_null)})"
+
+    count = 0
+
+    def chunks():
+        nonlocal count
+        for batch in batches(itertools.chain([first], rows), batch_size):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in batch:
+                writer.writerow([encode_value(row[name]) for name in names])
+            count += len(batch)
+            progress(table.name, count)
+            yield buffer.getvalue()
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(names)}) FROM STDIN WITH ({options})",
+            IterFile(chunks())
+        )
+    finally:
+        cursor.close()
+    return count
+
+
+def insert_rows(
+    connection: Connection,
+    table: Table,
+    rows: Iterable[dict],
+    batch_size: int,
+    progress: Progress,
+) -> int:
+    """Load rows with batched executemany INSERTs"""
+    count = 0
+    for batch in batches(rows, batch_size):
+        connection.execute(table.insert(), batch)
+        count += len(batch)
+        progress(table.name, count)
+    return count
+
+
+def import_database(
+    connection: Connection, directory: str, fmt: str, batch_size: int, progress: Progress
+) -> Dict[str, int]:
+    """Import the table files found in `directory`, in one transaction"""
+    offsets = {
+        table.name: connection.scalar(select(func.coalesce(func.max(table.c.id), 0)))
+        for table in TABLES
+    }
+    postgres = connection.dialect.name == "postgresql"
+    load = copy_rows if postgres else insert_rows
+
+    counts = {}
+    for table in TABLES:
+        path = table_path(directory, table, fmt)
+        if not os.path.exists(path):
+            continue
+        with open(path, newline="") as file:
+            rows = prepare_rows(table, read_rows(file, fmt), offsets)
+            counts[table.name] = load(connection, table, rows, batch_size, progress)
+
+        if postgres and table.name not in NEW_IDS:
+            # Rows were inserted with explicit ids, move the sequence past them
+            connection.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)"
+            )
+    return counts
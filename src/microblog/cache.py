@@ -0,0 +1,154 @@
+# cache.py
+#
+# Caches for data that is expensive to compute and shared between
+# requests, such as timeline pages. Pick a backend with CACHE_URL:
+#
+#   memory://                    per process (default)
+#   sqlite:////path/to/cache.db  shared by all workers on the host
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from sqlalchemy.engine import make_url
+
+from .lru import LRUCache
+
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1000"))
+
+
+class Cache:
+    """Base class for cache backends.
+
+    Besides values, a backend stores version counters. Cache keys embed a
+    version, so bumping it invalidates every entry built from the old one,
+    for all processes sharing the backend.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any:
+        """Return the value stored for `key`, or None"""
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def version(self, name: str) -> int:
+        raise NotImplementedError
+
+    def bump(self, name: str) -> None:
+        """Increment the version counter `name`"""
+        raise NotImplementedError
+
+    def get_or_set(self, key: str, compute: Callable[[], Any], store: bool = True) -> Any:
+        """The value of `key`, computed and (if `store`) cached when missing"""
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+            value = compute()
+            if store:
+                self.set(key, value)
+        else:
+            self.hits += 1
+        return value
+
+
+class MemoryCache(Cache):
+    """Cache in the memory of the current process"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__()
+        self.values = LRUCache(maxsize, ttl)
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        return self.values.get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        self.values.set(key, value)
+
+    def version(self, name: str) -> int:
+        return self.versions.get(name, 0)
+
+    def bump(self, name: str) -> None:
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+
+class SQLiteCache(Cache):
+    """Cache in an SQLite file, shared by every process that opens it"""
+
+    def __init__(self, path: str, ttl: float):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.sets = 0
+        with self.connection() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache_values "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache_versions "
+                "(name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can not be shared between threads
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return self.local.db
+
+    def get(self, key: str) -> Any:
+        row = self.connection().execute(
+            "SELECT value FROM cache_values WHERE key = ? AND expires > ?",
+            (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any) -> None:
+        db = self.connection()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO cache_values VALUES (?, ?, ?)",
+            (key, pickle.dumps(value), now + self.ttl)
+        )
+        self.sets += 1
+        if self.sets % 100 == 0:
+            db.execute("DELETE FROM cache_values WHERE expires <= ?", (now,))
+
+    def version(self, name: str) -> int:
+        row = self.connection().execute(
+            "SELECT version FROM cache_versions WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name: str) -> None:
+        self.connection().execute(
+            "INSERT INTO cache_versions VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+            (name,)
+        )
+
+
+def cache_from_url(url: str) -> Cache:
+    parsed = make_url(url)
+    if parsed.drivername == "memory":
+        return MemoryCache(CACHE_SIZE, CACHE_TTL)
+    if parsed.drivername == "sqlite":
+        return SQLiteCache(parsed.database, CACHE_TTL)
+    raise ValueError(f"Unsupported CACHE_URL: {url}")
+
+
+# Timeline pages and user profile lookups
+timeline_cache = cache_from_url(CACHE_URL)
@@ -0,0 +1,105 @@
+# Command line tools for maintaining a microblog database
+import argparse
+import sys
+
+from .bulk import FORMATS, export_database, import_database
+from .counters import reconcile_counters
+from .database import SessionLocal, engine
+from .fanout import rebuild_timelines
+
+
+def reconcile_counters_command(args: argparse.Namespace) -> None:
+    db = SessionLocal()
+    try:
+        repaired = reconcile_counters(db)
+    finally:
+        db.close()
+    print(f"Repaired counters on {repaired} posts")
+
+
+def rebuild_timelines_command(args: argparse.Namespace) -> None:
+    db = SessionLocal()
+    try:
+        rebuild_timelines(db)
+    finally:
+        db.close()
+    print("Rebuilt materialized timelines")
+
+
+def compile_templates_command(args: argparse.Namespace) -> None:
+    from .template_utils import TEMPLATE_BYTECODE_CACHE, compile_templates
+
+    if not TEMPLATE_BYTECODE_CACHE:
+        sys.exit("TEMPLATE_BYTECODE_CACHE is disabled, there is nothing to compile into")
+    print(f"Compiled {compile_templates()} templates")
+
+
+def print_progress(table: str, rows: int) -> None:
+    print(f"{table}: {rows} rows", file=sys.stderr)
+
+
+def export_command(args: argparse.Namespace) -> None:
+    with engine.connect() as connection:
+        counts = export_database(
+            connection, args.directory, args.format, args.batch_size, print_progress
+        )
+    for table, rows in counts.items():
+        print(f"Exported {rows} rows from {table}")
+
+
+def import_command(args: argparse.Namespace) -> None:
+    with engine.begin() as connection:
+        counts = import_database(
+            connection, args.directory, args.format, args.batch_size, print_progress
+        )
+    for table, rows in counts.items():
+        print(f"Imported {rows} rows into {table}")
+    print("Run rebuild-timelines if materialized timelines are enabled")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="microblog")
+    commands = parser.add_subparsers(required=True)
+
+    reconcile = commands.add_parser(
+        "reconcile-counters",
+        help="recount likes and replies where the stored counters have drifted"
+    )
+    reconcile.set_defaults(func=reconcile_counters_command)
+
+    rebuild = commands.add_parser(
+        "rebuild-timelines",
+        help="recreate the materialized timelines from the posts"
+    )
+    rebuild.set_defaults(func=rebuild_timelines_command)
+
+    compile_ = commands.add_parser(
+        "compile-templates",
+        help="compile the templates into the bytecode cache, e.g. when building an image"
+    )
+    compile_.set_defaults(func=compile_templates_command)
+
+    export = commands.add_parser(
+        "export",
+        help="write users, posts and likes to one file per table in a directory"
+    )
+    export.add_argument("directory")
+    export.add_argument("--format", choices=FORMATS, default="ndjson")
+    export.add_argument("--batch-size", type=int, default=10000)
+    export.set_defaults(func=export_command)
+
+    import_ = commands.add_parser(
+        "import",
+        help="add the users, posts and likes exported to a directory, with new ids"
+    )
+    import_.add_argument("directory")
+    import_.add_argument("--format", choices=FORMATS, default="ndjson")
+    import_.add_argument("--batch-size", type=int, default=10000)
+    import_.set_defaults(func=import_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# counters.py
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.orm import Session, aliased
+
+from .models import MicroblogPost, PostLike
+
+
+def adjust_like_count(db: Session, post_id: int, delta: int) -> None:
+    """Add `delta` to the like counter of a post.
+
+    The increment happens in SQL so concurrent likes of the same post
+    never overwrite each other. Call it in the same transaction as the
+    insert/delete of the PostLike row.
+    """
+    db.execute(
+        update(MicroblogPost)
+        .where(MicroblogPost.id == post_id)
+        .values(like_count=MicroblogPost.like_count + delta)
+    )
+
+
+def adjust_reply_count(db: Session, post_id: int, delta: int) -> None:
+    """Add `delta` to the reply counter of a post, see `adjust_like_count`"""
+    db.execute(
+        update(MicroblogPost)
+        .where(MicroblogPost.id == post_id)
+        .values(reply_count=MicroblogPost.reply_count + delta)
+    )
+
+
+def reconcile_counters(db: Session) -> int:
+    """Recount likes and replies for posts whose counters have drifted.
+
+    Returns the number of posts that were repaired.
+    """
+    reply = aliased(MicroblogPost)
+    actual_likes = (
+        select(func.count(PostLike.id))
+        .where(PostLike.post_id == MicroblogPost.id)
+        .scalar_subquery()
+    )
+    actual_replies = (
+        select(func.count(reply.id))
+        .where(reply.in_reply_to_post_id == MicroblogPost.id)
+        .scalar_subquery()
+    )
+    result = db.execute(
+        update(MicroblogPost)
+        .where(or_(
+            MicroblogPost.like_count != actual_likes,
+            MicroblogPost.reply_count != actual_replies
+        ))
+        .values(like_count=actual_likes, reply_count=actual_replies)
+    )
+    db.commit()
+    return result.rowcount
@@ -0,0 +1,163 @@
+# events.py
+#
+# In-process publish/subscribe of timeline events (new posts, deleted
+# posts, like counts), streamed to browsers over Server-Sent Events.
+#
+# Every subscriber gets a bounded queue. A subscriber that falls
+# EVENT_QUEUE_SIZE events behind is dropped, its stream ends and the
+# browser reconnects, instead of the queue growing without bound.
+#
+# With several workers, set EVENTS_POSTGRES_BRIDGE=true to pass events
+# between them through PostgreSQL LISTEN/NOTIFY.
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+import uuid
+from typing import List, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+# Seconds between keep-alive comments on idle streams
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", "15"))
+EVENTS_POSTGRES_BRIDGE = os.getenv("EVENTS_POSTGRES_BRIDGE", "false").lower() == "true"
+EVENTS_CHANNEL = "microblog_events"
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """The next event, None when the subscription was dropped.
+
+        Raises asyncio.TimeoutError if nothing arrives within `timeout`.
+        """
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class EventBus:
+    def __init__(self):
+        self.subscriptions: Set[Subscription] = set()
+        self.bridge: Optional[PostgresBridge] = None
+        # Tells this process' own notifications apart from other workers'
+        self.origin = uuid.uuid4().hex
+        self.dropped = 0
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(EVENT_QUEUE_SIZE)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    def deliver(self, event: dict) -> None:
+        """Pass an event to the subscribers of this process"""
+        for subscription in list(self.subscriptions):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too slow, make room for the None that ends its stream
+                self.unsubscribe(subscription)
+                self.dropped += 1
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(None)
+
+    async def publish(self, event_type: str, **data) -> None:
+        event = {"type": event_type, **data}
+        self.deliver(event)
+        if self.bridge is not None:
+            try:
+                await run_in_threadpool(self.bridge.notify, dict(event, origin=self.origin))
+            except Exception:
+                logger.exception("Could not forward %s event to other workers", event_type)
+
+    def start_bridge(self) -> None:
+        self.bridge = PostgresBridge(self, asyncio.get_running_loop())
+        self.bridge.start()
+
+    def stop_bridge(self) -> None:
+        if self.bridge is not None:
+            self.bridge.stop()
+            self.bridge = None
+
+
+class PostgresBridge(threading.Thread):
+    """Forwards events between workers with LISTEN/NOTIFY.
+
+    Uses a connection of its own, outside the pool, in autocommit mode.
+    """
+
+    def __init__(self, bus: EventBus, loop: asyncio.AbstractEventLoop):
+        super().__init__(name="events-bridge", daemon=True)
+        self.bus = bus
+        self.loop = loop
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        connection = engine.raw_connection()
+        connection.detach()
+        self.connection = connection.dbapi_connection
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {EVENTS_CHANNEL}")
+
+    def notify(self, event: dict) -> None:
+        with self.lock, self.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (EVENTS_CHANNEL, json.dumps(event)))
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            if not select.select([self.connection], [], [], 1)[0]:
+                continue
+            with self.lock:
+                self.connection.poll()
+                notifies: List = list(self.connection.notifies)
+                self.connection.notifies.clear()
+            for notify in notifies:
+                event = json.loads(notify.payload)
+                if event.pop("origin", None) != self.bus.origin:
+                    self.loop.call_soon_threadsafe(self.bus.deliver, event)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+        self.connection.close()
+
+
+def format_event(event: dict) -> str:
+    """An event in the text/event-stream format"""
+    data = {key: value for key, value in event.items() if key != "type"}
+    return f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+
+async def event_stream(bus: EventBus):
+    """Yield a subscriber's events in the text/event-stream format until it
+    is dropped or the client disconnects"""
+    subscription = bus.subscribe()
+    try:
+        # Reconnect after 5 seconds, e.g. after being dropped
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await subscription.get(EVENT_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # Comments keep proxies from closing idle connections
+                yield ": ping\n\n"
+                continue
+            if event is None:
+                return
+            yield format_event(event)
+    finally:
+        bus.unsubscribe(subscription)
+
+
+event_bus = EventBus()
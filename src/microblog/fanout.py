@@ -0,0 +1,170 @@
+# fanout.py
+#
+# Precomputed (materialized) timelines. When MATERIALIZED_TIMELINES is
+# enabled, new posts are written into the timeline_entries table of every
+# timeline they belong to by a background worker (fan-out-on-write), and
+# the front page reads those entries instead of scanning all posts.
+#
+# Each timeline keeps only its newest TIMELINE_MAX_ENTRIES entries. Pages
+# past that window are read from the posts table (fan-out-on-read).
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from sqlalchemy import delete, insert, literal, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from .cache import timeline_cache
+from .database import SessionLocal
+from .models import MicroblogPost, TimelineEntry
+from .timeline import paginate, timeline_query
+
+logger = logging.getLogger(__name__)
+
+MATERIALIZED_TIMELINES = os.getenv("MATERIALIZED_TIMELINES", "false").lower() == "true"
+TIMELINE_MAX_ENTRIES = int(os.getenv("TIMELINE_MAX_ENTRIES", "800"))
+
+# The front page, all top-level posts
+GLOBAL_TIMELINE = 0
+
+
+def timelines_for_post(post: MicroblogPost) -> List[int]:
+    """The ids of the materialized timelines a post belongs to"""
+    if post.in_reply_to_post_id is None:
+        return [GLOBAL_TIMELINE]
+    return []
+
+
+def prune_timeline(db: Session, timeline_id: int) -> None:
+    """Delete entries beyond the newest TIMELINE_MAX_ENTRIES of a timeline"""
+    oldest_kept = db.execute(
+        select(TimelineEntry.created_at, TimelineEntry.post_id)
+        .where(TimelineEntry.timeline_id == timeline_id)
+        .order_by(TimelineEntry.created_at.desc(), TimelineEntry.post_id.desc())
+        .offset(TIMELINE_MAX_ENTRIES - 1)
+        .limit(1)
+    ).first()
+    if oldest_kept is None:
+        return
+
+    db.execute(
+        delete(TimelineEntry).where(
+            TimelineEntry.timeline_id == timeline_id,
+            (TimelineEntry.created_at < oldest_kept.created_at)
+            | (
+                (TimelineEntry.created_at == oldest_kept.created_at)
+                & (TimelineEntry.post_id < oldest_kept.post_id)
+            )
+        )
+    )
+
+
+def fan_out(db: Session, post_ids: List[int]) -> None:
+    """Write posts into the timelines they belong to.
+
+    Deleted posts need no work, their entries are removed by the foreign
+    key's ON DELETE CASCADE.
+    """
+    touched = set()
+    posts = db.query(MicroblogPost).filter(MicroblogPost.id.in_(post_ids))
+    for post in posts:
+        for timeline_id in timelines_for_post(post):
+            db.add(TimelineEntry(
+                timeline_id=timeline_id, post_id=post.id, created_at=post.created_at
+            ))
+            touched.add(timeline_id)
+
+    db.flush()
+    for timeline_id in touched:
+        prune_timeline(db, timeline_id)
+    db.commit()
+
+
+def rebuild_timelines(db: Session) -> None:
+    """Recreate all materialized timelines from the posts table"""
+    db.execute(delete(TimelineEntry))
+    db.execute(
+        insert(TimelineEntry).from_select(
+            ["timeline_id", "post_id", "created_at"],
+            select(literal(GLOBAL_TIMELINE), MicroblogPost.id, MicroblogPost.created_at)
+            .where(MicroblogPost.in_reply_to_post_id == None)
+            .order_by(MicroblogPost.created_at.desc(), MicroblogPost.id.desc())
+            .limit(TIMELINE_MAX_ENTRIES)
+        )
+    )
+    db.commit()
+
+
+def load_global_timeline_page(db: Session, before: Optional[str], limit: int):
+    """Return one page of top-level posts, and the next cursor"""
+    if MATERIALIZED_TIMELINES:
+        page, next_cursor = paginate(
+            timeline_query(db)
+            .join(TimelineEntry, TimelineEntry.post_id == MicroblogPost.id)
+            .filter(TimelineEntry.timeline_id == GLOBAL_TIMELINE),
+            before,
+            limit,
+            keyset=(TimelineEntry.created_at, TimelineEntry.post_id)
+        )
+        # Without a next cursor the page may have hit the end of the
+        # materialized window, let the posts table fill it in
+        if next_cursor is not None:
+            return page, next_cursor
+
+    return paginate(
+        timeline_query(db).filter(MicroblogPost.in_reply_to_post_id == None),
+        before,
+        limit
+    )
+
+
+class FanoutWorker:
+    """Background task that fans out new posts in batches"""
+
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    def enqueue(self, post_id: int) -> None:
+        if self.queue is not None:
+            self.queue.put_nowait(post_id)
+
+    async def run(self) -> None:
+        while True:
+            post_ids = [await self.queue.get()]
+            while not self.queue.empty():
+                post_ids.append(self.queue.get_nowait())
+            try:
+                await run_in_threadpool(self.fan_out_in_session, post_ids)
+                timeline_cache.bump("timelines")
+            except Exception:
+                logger.exception("Fan-out of posts %s failed", post_ids)
+            finally:
+                for _ in post_ids:
+                    self.queue.task_done()
+
+    @staticmethod
+    def fan_out_in_session(post_ids: List[int]) -> None:
+        db = SessionLocal()
+        try:
+            fan_out(db, post_ids)
+        finally:
+            db.close()
+
+    async def stop(self) -> None:
+        """Finish the queued fan-outs and stop"""
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None
+        self.queue = None
+
+
+fanout_worker = FanoutWorker()
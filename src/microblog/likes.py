@@ -0,0 +1,147 @@
+# likes.py
+#
+# Liking and unliking posts without read-then-write races. The unique
+# index on (post_id, user_id) makes the insert of a like an upsert
+# (ON CONFLICT DO NOTHING), unlikes are DELETE ... RETURNING, and the
+# post's like counter is adjusted by what those statements actually
+# changed, returning the new count.
+#
+# On PostgreSQL all of it is a single statement, with the insert and the
+# delete in data-modifying CTEs. SQLite runs the same steps as separate
+# statements in one transaction.
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, exists, func, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .models import MicroblogPost, PostLike, User
+
+LIKE = "like"
+UNLIKE = "unlike"
+TOGGLE = "toggle"
+ACTIONS = (LIKE, UNLIKE, TOGGLE)
+
+
+@dataclass
+class LikeResult:
+    post_id: int
+    liked: bool
+    like_count: int
+    changed: bool
+
+
+def delete_like(post_id: int, user_id: int):
+    return (
+        delete(PostLike)
+        .where(PostLike.post_id == post_id, PostLike.user_id == user_id)
+        .returning(PostLike.id)
+    )
+
+
+def insert_like(dialect: str, post_id: int, user_id: int, unless=None):
+    """INSERT of a like that does nothing if it exists, if the post or
+    the user does not, or if the `unless` CTE has rows"""
+    rows = select(literal(post_id), literal(user_id)).where(
+        exists().where(MicroblogPost.id == post_id),
+        exists().where(User.id == user_id),
+    )
+    if unless is not None:
+        rows = rows.where(~exists(select(unless.c.id)))
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    return (
+        insert(PostLike)
+        .from_select(["post_id", "user_id"], rows)
+        .on_conflict_do_nothing(index_elements=[PostLike.post_id, PostLike.user_id])
+        .returning(PostLike.id)
+    )
+
+
+def add_to_like_count(post_id: int, delta, *returning):
+    return (
+        update(MicroblogPost)
+        .where(MicroblogPost.id == post_id)
+        .values(like_count=MicroblogPost.like_count + delta)
+        .returning(MicroblogPost.like_count, *returning)
+    )
+
+
+def change_like_postgresql(db: Session, user_id: int, post_id: int, action: str):
+    deleted = inserted = None
+    if action in (UNLIKE, TOGGLE):
+        deleted = delete_like(post_id, user_id).cte("deleted")
+    if action in (LIKE, TOGGLE):
+        inserted = insert_like("postgresql", post_id, user_id, unless=deleted).cte("inserted")
+
+    def count(cte):
+        if cte is None:
+            return literal(0)
+        return select(func.count()).select_from(cte).scalar_subquery()
+
+    statement = add_to_like_count(
+        post_id,
+        count(inserted) - count(deleted),
+        count(inserted).label("inserted"),
+        count(deleted).label("deleted"),
+    )
+    for cte in (deleted, inserted):
+        if cte is not None:
+            statement = statement.add_cte(cte)
+    return db.execute(statement).first()
+
+
+def change_like_sqlite(db: Session, user_id: int, post_id: int, action: str):
+    deleted = inserted = 0
+    if action in (UNLIKE, TOGGLE):
+        deleted = len(db.execute(delete_like(post_id, user_id)).all())
+    if action == LIKE or (action == TOGGLE and not deleted):
+        inserted = len(db.execute(insert_like("sqlite", post_id, user_id)).all())
+    row = db.execute(add_to_like_count(post_id, inserted - deleted)).first()
+    if row is None:
+        return None
+    return (row.like_count, inserted, deleted)
+
+
+def apply_like(db: Session, user_id: int, post_id: int, action: str) -> Optional[LikeResult]:
+    """Like, unlike or toggle the like of a post, without committing.
+
+    Returns None if the post does not exist. Liking a liked post, or
+    unliking a post that is not liked, changes nothing, so repeated
+    (double submitted) requests are harmless.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        row = change_like_postgresql(db, user_id, post_id, action)
+    else:
+        row = change_like_sqlite(db, user_id, post_id, action)
+    if row is None:
+        return None
+
+    like_count, inserted, deleted = row
+    if action == TOGGLE:
+        liked = not deleted
+    else:
+        liked = action == LIKE
+    return LikeResult(post_id, liked, like_count, bool(inserted or deleted))
+
+
+def change_like(db: Session, user_id: int, post_id: int, action: str) -> Optional[LikeResult]:
+    """`apply_like` and commit"""
+    result = apply_like(db, user_id, post_id, action)
+    db.commit()
+    return result
+
+
+def change_likes(db: Session, user_id: int, liked: Dict[int, bool]) -> List[LikeResult]:
+    """Like or unlike several posts in one transaction, from a map of post
+    id to whether it should be liked. Posts that do not exist are left out
+    of the results."""
+    results = []
+    # Lock the posts in the same order in every transaction, so two
+    # batches can not deadlock
+    for post_id, state in sorted(liked.items()):
+        result = apply_like(db, user_id, post_id, LIKE if state else UNLIKE)
+        if result is not None:
+            results.append(result)
+    db.commit()
+    return results
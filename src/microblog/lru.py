@@ -0,0 +1,66 @@
+# lru.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+
+class LRUCache:
+    """A size bounded least-recently-used mapping, with optional expiry.
+
+    Counts hits and misses, and is safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or (item[1] is not None and item[1] < time.monotonic()):
+                self.misses += 1
+                self.data.pop(key, None)
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        """The cached values of `keys`, missing keys are left out"""
+        found = {}
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                item = self.data.get(key)
+                if item is None or (item[1] is not None and item[1] < now):
+                    self.misses += 1
+                    self.data.pop(key, None)
+                    continue
+                self.data.move_to_end(key)
+                found[key] = item[0]
+            self.hits += len(found)
+        return found
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
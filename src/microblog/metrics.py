@@ -0,0 +1,363 @@
+# metrics.py
+#
+# Request, database and template metrics, served on /metrics in the
+# Prometheus text format. Disable with METRICS_ENABLED=false.
+#
+# Per request the middleware records latency by route, and the number
+# of SQL statements and the time spent in them. Statements are counted
+# through SQLAlchemy cursor events, and attributed to the request through
+# a context variable, which is carried into the threadpool and into
+# AsyncSession.run_sync.
+import bisect
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from jinja2 import Environment, Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .cache import timeline_cache
+from .events import event_bus
+from .passwords import password_hasher
+from .template_utils import post_fragments
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """Yield (suffix, label names, label values, value) tuples"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(names, values)} {format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield "", self.labelnames, labels, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (not cumulative) + overflow, sum]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        names = self.labelnames + ("le",)
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, labels + (format_value(bound),), cumulative
+            yield "_sum", self.labelnames, labels, total
+            yield "_count", self.labelnames, labels, cumulative
+
+
+class Gauge(Metric):
+    """A value read when the metrics are scraped.
+
+    `collect` returns the value, or a dict from label value tuples to
+    values when the gauge has labels. Counters kept by other objects are
+    exported as gauges with kind="counter".
+    """
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], object],
+        labelnames: Sequence[str] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        values = self.collect()
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in values.items():
+            yield "", self.labelnames, labels, value
+
+
+registry: List[Metric] = []
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+http_requests = Counter(
+    "microblog_http_requests_total",
+    "HTTP requests by route and status code",
+    ("method", "route", "status"),
+)
+http_request_seconds = Histogram(
+    "microblog_http_request_duration_seconds",
+    "HTTP request latency by route",
+    ("method", "route"),
+)
+request_db_queries = Histogram(
+    "microblog_request_db_queries",
+    "SQL statements executed per HTTP request",
+    ("route",),
+    COUNT_BUCKETS,
+)
+request_db_seconds = Histogram(
+    "microblog_request_db_duration_seconds",
+    "Time spent executing SQL statements per HTTP request",
+    ("route",),
+)
+db_query_seconds = Histogram(
+    "microblog_db_query_duration_seconds",
+    "SQL statement execution time",
+)
+db_pool_wait_seconds = Histogram(
+    "microblog_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+)
+template_render_seconds = Histogram(
+    "microblog_template_render_duration_seconds",
+    "Jinja template render time by template",
+    ("template",),
+)
+
+
+# Components that keep their own counters
+Gauge(
+    "microblog_cache_requests_total",
+    "Cache lookups by cache and result",
+    lambda: {
+        ("timelines", "hit"): timeline_cache.hits,
+        ("timelines", "miss"): timeline_cache.misses,
+        ("post_fragments", "hit"): post_fragments.hits,
+        ("post_fragments", "miss"): post_fragments.misses,
+    },
+    ("cache", "result"),
+    kind="counter",
+)
+Gauge(
+    "microblog_password_hasher",
+    "Password hash and verify jobs of the process pool",
+    lambda: {(key,): value for key, value in password_hasher.metrics().items()},
+    ("stat",),
+)
+Gauge(
+    "microblog_event_subscribers",
+    "Open Server-Sent Events streams",
+    lambda: len(event_bus.subscriptions),
+)
+Gauge(
+    "microblog_event_subscribers_dropped_total",
+    "Event streams closed for falling behind",
+    lambda: event_bus.dropped,
+    kind="counter",
+)
+
+
+class RequestStats:
+    __slots__ = ("queries", "query_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+# Stats of the HTTP request being handled, None outside of requests
+current_request: ContextVar[Optional[RequestStats]] = ContextVar(
+    "current_request", default=None
+)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    db_query_seconds.observe(elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += elapsed
+
+
+def time_pool_checkouts(engine: Engine) -> None:
+    pool = engine.pool
+    do_get = pool._do_get
+
+    def timed_do_get():
+        start = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_pool_wait_seconds.observe(time.perf_counter() - start)
+
+    pool._do_get = timed_do_get
+
+
+# Instrumented engines by name, for the pool gauge
+engines: Dict[str, Engine] = {}
+
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    """Record statement times and pool checkout waits of a sync engine
+    (for an AsyncEngine, pass its `sync_engine`)"""
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    time_pool_checkouts(engine)
+    # dispose() replaces the pool
+    event.listen(engine, "engine_disposed", time_pool_checkouts)
+    engines[name] = engine
+
+
+def pool_connections() -> dict:
+    values = {}
+    for name, engine in engines.items():
+        values[name, "checked_out"] = engine.pool.checkedout()
+        values[name, "idle"] = engine.pool.checkedin()
+    return values
+
+
+Gauge(
+    "microblog_db_pool_connections",
+    "Pooled database connections by engine and state",
+    pool_connections,
+    ("engine", "state"),
+)
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs) -> str:
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            template_render_seconds.observe(time.perf_counter() - start, self.name)
+
+
+def instrument_templates(env: Environment) -> None:
+    """Time every render() of templates loaded from `env` from now on"""
+    env.template_class = TimedTemplate
+
+
+def route_label(scope: dict, root_path: str) -> str:
+    # Routing stores the matched route in the scope
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    # Mounts, like /static, only extend the root path
+    if scope.get("root_path", "") != root_path:
+        return scope["root_path"]
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and SQL statements per route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        root_path = scope.get("root_path", "")
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = route_label(scope, root_path)
+            http_requests.inc(scope["method"], route, status)
+            http_request_seconds.observe(elapsed, scope["method"], route)
+            request_db_queries.observe(stats.queries, route)
+            request_db_seconds.observe(stats.query_seconds, route)
@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, select, func
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Index, select, func
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -17,6 +17,10 @@ class PostLike(Base):
     liked_by = relationship("User", back_populates="likes", foreign_keys=[user_id])
     post = relationship("MicroblogPost", back_populates="likes", foreign_keys=[post_id])
 
+    __table_args__ = (
+        Index("uq_microblog_likes_post_id_user_id", post_id, user_id, unique=True),
+    )
+
 
 class MicroblogPost(Base):
     __tablename__ = "microblog_posts"
@@ -27,6 +31,28 @@ class MicroblogPost(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     in_reply_to_post_id = Column(Integer, ForeignKey("microblog_posts.id", ondelete="SET NULL"), nullable=True)
     in_reply_to_user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    # Denormalized counters, kept up to date by the routers (see counters.py)
+    like_count = Column(Integer, nullable=False, default=0, server_default="0")
+    reply_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        Index(
+            "ix_microblog_posts_timeline",
+            created_at.desc(),
+            id.desc(),
+            postgresql_where=in_reply_to_post_id.is_(None),
+            sqlite_where=in_reply_to_post_id.is_(None),
+        ),
+        Index("ix_microblog_posts_author_id_created_at", author_id, created_at.desc(), id.desc()),
+        # Replies only, so the front page's IS NULL filter can not pick it
+        # over the timeline index
+        Index(
+            "ix_microblog_posts_in_reply_to_post_id",
+            in_reply_to_post_id,
+            postgresql_where=in_reply_to_post_id.isnot(None),
+            sqlite_where=in_reply_to_post_id.isnot(None),
+        ),
+    )
 
     author = relationship("User", back_populates="posts", foreign_keys=[author_id])
     replies = relationship(
@@ -84,3 +110,32 @@ class User(Base):
         back_populates="liked_by",
         viewonly=True
     )
+
+
+class TimelineEntry(Base):
+    """A post materialized into a precomputed timeline, see fanout.py"""
+    __tablename__ = "timeline_entries"
+
+    timeline_id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey("microblog_posts.id", ondelete="CASCADE"), primary_key=True)
+    # Copied from the post, so timelines can be paged without the posts table
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_timeline_entries_timeline", timeline_id, created_at.desc(), post_id.desc()),
+    )
+
+
+class UserSession(Base):
+    """A login, when sessions are stored server side (SESSION_STORE=database)"""
+    __tablename__ = "user_sessions"
+
+    # Random id, signed into the session cookie
+    id = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_user_sessions_user_id", user_id),
+    )
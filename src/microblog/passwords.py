@@ -0,0 +1,123 @@
+# passwords.py
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+# bcrypt cost factor. Changing it rehashes passwords on their next login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Worker processes used for hashing, defaults to one per core
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hashing jobs allowed to wait for a worker before requests are rejected
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+
+def crypt_context(rounds: int) -> CryptContext:
+    return CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    return crypt_context(rounds).hash(password)
+
+
+def verify_and_update(
+    password: str, hashed: str, rounds: int = BCRYPT_ROUNDS
+) -> Tuple[bool, Optional[str]]:
+    """Verify a password, and rehash it if `hashed` used another cost factor.
+
+    Returns whether the password matched, and the new hash if one was made.
+    """
+    return crypt_context(rounds).verify_and_update(password, hashed)
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a pool of worker processes.
+
+    bcrypt is CPU bound and slow on purpose, so running it in processes
+    keeps the event loop free and lets logins scale with the cores. At
+    most `max_pending` jobs may be queued or running, further requests
+    get a 503 instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_pending: int, rounds: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+        # Metrics
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.latency_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many login attempts, try again")
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            executor = self.start()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+            except BrokenProcessPool:
+                # A worker died (killed for memory, crashed), which breaks
+                # the whole pool. Replace it and try once more.
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.restart(executor), fn, *args
+                )
+        finally:
+            elapsed = time.perf_counter() - start
+            self.pending -= 1
+            self.completed += 1
+            self.latency_seconds_total += elapsed
+            self.latency_seconds_max = max(self.latency_seconds_max, elapsed)
+
+    def start(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self.executor
+
+    def restart(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """Replace the pool `broken`, unless a concurrent job already did"""
+        if self.executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        return self.start()
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password, self.rounds)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        return await self.run(verify_and_update, password, hashed, self.rounds)
+
+    def metrics(self) -> dict:
+        return {
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "latency_seconds_total": self.latency_seconds_total,
+            "latency_seconds_max": self.latency_seconds_max,
+        }
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+password_hasher = PasswordHasher(
+    PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, BCRYPT_ROUNDS
+)
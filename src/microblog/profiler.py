@@ -0,0 +1,222 @@
+# profiler.py
+#
+# Opt-in profiling of slow requests, enabled with PROFILE_REQUESTS=true.
+#
+# A fraction (PROFILE_SAMPLE_RATE) of requests is profiled by sampling
+# the stacks of all threads every PROFILE_INTERVAL_MS, so the threadpool
+# work of the request is seen too. One request is profiled at a time.
+# When a profiled request takes longer than PROFILE_THRESHOLD_MS, its
+# stacks (in the collapsed format read by flamegraph.pl and speedscope),
+# SQL statements and timing are saved to PROFILE_DIR. Only the newest
+# PROFILE_MAX_CAPTURES captures are kept.
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import route_label
+
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", "500"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "microblog-profiles")
+)
+PROFILE_MAX_CAPTURES = int(os.getenv("PROFILE_MAX_CAPTURES", "100"))
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of all other threads until stopped"""
+
+    def __init__(self, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        """Stop sampling and return the stacks in collapsed format"""
+        self.stopped.set()
+        self.join()
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.items())
+
+
+class Capture:
+    def __init__(self):
+        self.statements: List[dict] = []
+
+
+# Capture of the request being profiled, None otherwise
+current_capture: ContextVar[Optional[Capture]] = ContextVar("current_capture", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_capture.get() is not None:
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    capture = current_capture.get()
+    if capture is not None:
+        elapsed = time.perf_counter() - conn.info["profile_start"].pop()
+        capture.statements.append({"sql": statement, "seconds": elapsed})
+
+
+def profile_engine(engine: Engine) -> None:
+    """Record the SQL statements of profiled requests run on `engine`"""
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class ProfileStore:
+    """Captures saved as JSON files in a directory, newest `max_captures` kept"""
+
+    name_pattern = re.compile(r"^[0-9T]+-[0-9a-f]+$")
+
+    def __init__(self, directory: str, max_captures: int):
+        self.directory = directory
+        self.max_captures = max_captures
+        self.lock = threading.Lock()
+
+    def path(self, name: str) -> Optional[str]:
+        """The file of capture `name`, or None if there is no such capture"""
+        if not self.name_pattern.match(name):
+            return None
+        path = os.path.join(self.directory, f"{name}.json")
+        return path if os.path.exists(path) else None
+
+    def names(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            entry[:-len(".json")] for entry in os.listdir(self.directory)
+            if entry.endswith(".json")
+        )
+
+    def save(self, capture: dict) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        # Names sort by time, to the millisecond
+        now = time.time()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(now))
+        name = f"{stamp}{int(now * 1000) % 1000:03d}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(self.directory, f"{name}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(dict(capture, name=name), f)
+        os.replace(f"{path}.tmp", path)
+
+        with self.lock:
+            for old in self.names()[:-self.max_captures]:
+                try:
+                    os.remove(os.path.join(self.directory, f"{old}.json"))
+                except FileNotFoundError:
+                    pass
+        return name
+
+    def load(self, name: str) -> Optional[dict]:
+        path = self.path(name)
+        if path is None:
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def summaries(self) -> List[dict]:
+        """Captures without stacks and statements, newest first"""
+        summaries = []
+        for name in reversed(self.names()):
+            capture = self.load(name)
+            if capture is not None:
+                summary = {
+                    key: value for key, value in capture.items() if key != "stacks"
+                }
+                summary["statements"] = len(capture["statements"])
+                summaries.append(summary)
+        return summaries
+
+
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_MAX_CAPTURES)
+
+
+class ProfilerMiddleware:
+    """ASGI middleware profiling a sample of requests, see module comment"""
+
+    def __init__(self, app):
+        self.app = app
+        self.busy = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or random.random() >= PROFILE_SAMPLE_RATE
+            or not self.busy.acquire(blocking=False)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        root_path = scope.get("root_path", "")
+        capture = Capture()
+        token = current_capture.set(capture)
+        sampler = StackSampler(PROFILE_INTERVAL_MS / 1000)
+        started = time.time()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_capture.reset(token)
+            stacks = sampler.stop()
+            self.busy.release()
+
+        if elapsed * 1000 >= PROFILE_THRESHOLD_MS:
+            await run_in_threadpool(profile_store.save, {
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": route_label(scope, root_path),
+                "status": status,
+                "started": started,
+                "seconds": elapsed,
+                "db_seconds": sum(s["seconds"] for s in capture.statements),
+                "statements": capture.statements,
+                "stacks": stacks,
+            })
@@ -0,0 +1,339 @@
+# ratelimit.py
+#
+# Rate limiting and admission control, as ASGI middleware.
+#
+# Rate limiting (RATE_LIMITING=true) gives every client a token bucket per
+# budget. A client is the session user when the request has a valid
+# session cookie, otherwise its IP address. Logins and registrations are
+# always limited per IP address, since there is no user yet. A request
+# finding its bucket empty is answered with 429 and Retry-After.
+#
+# Budgets are "<requests>/<seconds>": a bucket holds up to <requests>
+# tokens and is refilled at <requests> per <seconds>. Override them with
+# RATE_LIMIT_<NAME>, an empty value turns a budget off:
+#
+#   login     POST /auth/login, /auth/register                      10/60
+#   create    POST /posts/create, /api/v1/posts                     30/60
+#   like      POST /posts/like, /api/v1/likes,
+#             PUT and DELETE /api/v1/posts/<id>/like               120/60
+#   timeline  GET /posts/, /posts/timeline, /posts/search(.json),
+#             /users/<name>(/timeline), /api/v1/posts,
+#             /api/v1/users/<name>/posts                           300/60
+#
+# Buckets are kept in the backend given by RATE_LIMIT_URL, like CACHE_URL:
+#
+#   memory://                    per process (default)
+#   sqlite:////path/to/limits.db shared by all workers on the host
+#
+# Admission control (ADMISSION_CONTROL=true) caps the number of requests
+# handled at once at ADMISSION_MAX_CONCURRENCY, by default the size of the
+# database pool including overflow. Up to ADMISSION_MAX_QUEUE more wait at
+# most ADMISSION_QUEUE_TIMEOUT seconds for their turn, the rest are
+# answered with 503 right away. This sheds load before requests would
+# queue for a database connection until DATABASE_POOL_TIMEOUT. The event
+# stream, metrics and static files are not counted.
+import asyncio
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from itsdangerous import BadSignature
+from sqlalchemy.engine import make_url
+from starlette.requests import cookie_parser
+
+from .database import DATABASE_MAX_OVERFLOW, DATABASE_POOL_SIZE
+from .routers.auth import serializer, verified_sessions
+
+RATE_LIMITING = os.getenv("RATE_LIMITING", "false").lower() == "true"
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL", "memory://")
+# Buckets kept by the memory backend, the least recently used are dropped
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "false").lower() == "true"
+ADMISSION_MAX_CONCURRENCY = int(os.getenv(
+    "ADMISSION_MAX_CONCURRENCY", str(DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW)
+))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", str(ADMISSION_MAX_CONCURRENCY)))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+
+# Budget name: (default, [(method, path pattern)])
+BUDGETS = {
+    "login": ("10/60", [
+        ("POST", r"/auth/(?:login|register)"),
+    ]),
+    "create": ("30/60", [
+        ("POST", r"/posts/create"),
+        ("POST", r"/api/v1/posts"),
+    ]),
+    "like": ("120/60", [
+        ("POST", r"/posts/like"),
+        ("POST", r"/api/v1/likes"),
+        ("PUT", r"/api/v1/posts/\d+/like"),
+        ("DELETE", r"/api/v1/posts/\d+/like"),
+    ]),
+    "timeline": ("300/60", [
+        ("GET", r"/posts/(?:timeline|search|search\.json)?"),
+        ("GET", r"/users/[^/]+(?:/timeline)?"),
+        ("GET", r"/api/v1/posts"),
+        ("GET", r"/api/v1/users/[^/]+/posts"),
+    ]),
+}
+# Budgets counted per IP address even for logged in users
+PER_IP_BUDGETS = {"login"}
+
+# Paths not counted by admission control
+UNCOUNTED_PATHS = {"/posts/events", "/metrics"}
+
+
+def parse_budget(budget: str) -> Optional[Tuple[float, float]]:
+    """"<requests>/<seconds>" as (tokens per second, bucket size)"""
+    if not budget:
+        return None
+    requests, seconds = budget.split("/")
+    return float(requests) / float(seconds), float(requests)
+
+
+def budgets_from_env() -> Dict[str, Tuple[float, float]]:
+    budgets = {}
+    for name, (default, _) in BUDGETS.items():
+        budget = parse_budget(os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+        if budget is not None:
+            budgets[name] = budget
+    return budgets
+
+
+def compile_routes(names) -> Dict[str, re.Pattern]:
+    """One pattern per method, its groups named after the budgets"""
+    patterns: Dict[str, Dict[str, list]] = {}
+    for name in names:
+        for method, path in BUDGETS[name][1]:
+            patterns.setdefault(method, {}).setdefault(name, []).append(path)
+    return {
+        method: re.compile("|".join(
+            f"(?P<{name}>{'|'.join(paths)})" for name, paths in by_name.items()
+        ))
+        for method, by_name in patterns.items()
+    }
+
+
+class RateLimitStore:
+    """Base class for token bucket backends"""
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """Take a token from the bucket `key`, which holds up to `burst`
+        tokens and gains `rate` tokens per second.
+
+        Returns 0 if a token was taken, otherwise the seconds until the
+        bucket has one.
+        """
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Buckets in the memory of the current process"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # key: [tokens, last update]
+        self.buckets: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                # A dropped bucket comes back full, as for a new client
+                bucket = self.buckets[key] = [burst, now]
+                if len(self.buckets) > self.maxsize:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Buckets in an SQLite file, shared by every process that opens it"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.takes = 0
+        with self.connection() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, "
+                "tokens REAL NOT NULL, updated REAL NOT NULL, taken INTEGER NOT NULL)"
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can not be shared between threads
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # Buckets lost in a crash only reset some limits, no need to
+            # wait for the disk on every request
+            db.execute("PRAGMA synchronous=OFF")
+            self.local.db = db
+        return self.local.db
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        db = self.connection()
+        now = time.time()
+        # The refill and the take in one statement, so workers can not
+        # both take the last token. All SET expressions see the old row.
+        tokens, taken = db.execute(
+            "INSERT INTO rate_limits VALUES (:key, :burst - 1, :now, 1) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "tokens = min(:burst, tokens + (:now - updated) * :rate) "
+            "  - (min(:burst, tokens + (:now - updated) * :rate) >= 1), "
+            "taken = min(:burst, tokens + (:now - updated) * :rate) >= 1, "
+            "updated = :now "
+            "RETURNING tokens, taken",
+            {"key": key, "burst": burst, "now": now, "rate": rate},
+        ).fetchone()
+        self.takes += 1
+        if self.takes % 1000 == 0:
+            # Buckets idle for an hour are full again in any budget
+            # refilling within the hour
+            db.execute("DELETE FROM rate_limits WHERE updated < ?", (now - 3600,))
+        if taken:
+            return 0.0
+        return (1 - tokens) / rate
+
+
+def rate_limit_store_from_url(url: str) -> RateLimitStore:
+    parsed = make_url(url)
+    if parsed.drivername == "memory":
+        return MemoryRateLimitStore(RATE_LIMIT_MAX_KEYS)
+    if parsed.drivername == "sqlite":
+        return SQLiteRateLimitStore(parsed.database)
+    raise ValueError(f"Unsupported RATE_LIMIT_URL: {url}")
+
+
+def session_user_id(scope) -> Optional[int]:
+    """The user id of a validly signed session cookie, if any"""
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            token = cookie_parser(value.decode("latin-1")).get("session_token")
+            break
+    else:
+        return None
+    if not token:
+        return None
+    user = verified_sessions.get(token)
+    if user is not None:
+        return user.id
+    try:
+        return serializer.loads(token)["user_id"]
+    except (BadSignature, KeyError, TypeError):
+        return None
+
+
+async def send_error(send, status: int, detail: str, retry_after: float) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """ASGI middleware answering 429 to clients over their budget"""
+
+    def __init__(self, app, store: Optional[RateLimitStore] = None, budgets=None):
+        self.app = app
+        self.store = store or rate_limit_store_from_url(RATE_LIMIT_URL)
+        self.budgets = budgets_from_env() if budgets is None else budgets
+        self.routes = compile_routes(self.budgets)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        routes = self.routes.get(scope["method"])
+        match = routes.fullmatch(scope["path"]) if routes is not None else None
+        if match is None:
+            await self.app(scope, receive, send)
+            return
+
+        budget = match.lastgroup
+        user_id = None if budget in PER_IP_BUDGETS else session_user_id(scope)
+        if user_id is not None:
+            key = f"{budget}:user:{user_id}"
+        else:
+            client = scope.get("client")
+            key = f"{budget}:ip:{client[0] if client else 'unknown'}"
+        rate, burst = self.budgets[budget]
+        wait = self.store.take(key, rate, burst)
+        if wait:
+            await send_error(send, 429, "Too many requests", wait)
+            return
+        await self.app(scope, receive, send)
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware limiting the requests handled at once, answering
+    503 when too many are waiting"""
+
+    def __init__(
+        self,
+        app,
+        max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.app = app
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.shed = 0
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] != "http"
+            or path in UNCOUNTED_PATHS
+            or path.startswith("/static/")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        if self.slots.locked():
+            if self.waiting >= self.max_queue:
+                self.shed += 1
+                await send_error(send, 503, "Server busy", self.queue_timeout)
+                return
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                await send_error(send, 503, "Server busy", self.queue_timeout)
+                return
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.slots.release()
@@ -1,5 +1,7 @@
+from .admin import admin
+from .api import api
 from .auth import auth
 from .posts import posts
 from .users import users
 
-__all__ = ["auth", "posts", "users"]
+__all__ = ["admin", "api", "auth", "posts", "users"]
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+
+from ..profiler import profile_store
+from .auth import get_admin_user_id
+
+admin = APIRouter(dependencies=[Depends(get_admin_user_id)])
+
+
+@admin.get("/profiles")
+async def list_profiles():
+    """List saved slow request profiles, newest first"""
+    return profile_store.summaries()
+
+
+@admin.get("/profiles/{name}")
+async def download_profile(name: str):
+    """Download a profile as JSON, with stacks, SQL statements and timing"""
+    path = profile_store.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=f"{name}.json")
+
+
+@admin.get("/profiles/{name}/stacks", response_class=PlainTextResponse)
+async def download_profile_stacks(name: str):
+    """Download the stacks of a profile in collapsed format, for
+    flamegraph.pl or speedscope"""
+    capture = profile_store.load(name)
+    if capture is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(capture["stacks"])
@@ -0,0 +1,239 @@
+# Versioned JSON API, mounted at /api/v1
+#
+# GET responses carry a weak ETag computed from the versions of the posts
+# they contain (see post_version), so clients can poll with
+# If-None-Match and get an empty 304 when nothing changed.
+import hashlib
+from typing import Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+from pydantic import BaseModel, Field
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse, Response
+from fastapi import APIRouter, HTTPException, Depends, Query
+
+from .auth import get_current_user_id, get_current_user_id_optional
+from .posts import (
+    MicroblogCreate, MicroblogOut, TimelinePage, TimelinePostOut, create_post,
+    invalidate_timelines, load_timeline_page
+)
+from .users import load_users_page
+
+from ..database import SessionRunner, get_async_db
+from ..events import event_bus
+from ..fanout import fanout_worker
+from ..likes import LIKE, UNLIKE, LikeResult, change_like, change_likes
+from ..models import MicroblogPost
+from ..template_utils import post_fragments, post_version
+from ..timeline import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, TimelinePost, timeline_query, with_liked
+)
+
+# Most likes and unlikes accepted in one batch
+MAX_LIKE_BATCH = 500
+
+api = APIRouter()
+
+
+def weak_etag(posts: Iterable[TimelinePost], *extra) -> str:
+    """A weak ETag that changes when any of `posts` changes"""
+    digest = hashlib.sha1()
+    for post in posts:
+        digest.update(repr((post.id, post_version(post), post.liked)).encode())
+    digest.update(repr(extra).encode())
+    return f'W/"{digest.hexdigest()[:20]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether If-None-Match lists `etag` (weak comparison)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    opaque = etag.removeprefix("W/")
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque:
+            return True
+    return False
+
+
+def conditional_response(
+    request: Request, content, etag: str, viewer_id: Optional[int]
+) -> Response:
+    """`content` as JSON, or 304 Not Modified if the client has it already"""
+    headers = {
+        "ETag": etag,
+        # Liked flags depend on who is logged in
+        "Vary": "Cookie",
+        "Cache-Control": "private, no-cache" if viewer_id else "public, no-cache",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(jsonable_encoder(content), headers=headers)
+
+
+def load_post(db: Session, post_id: int, viewer_id: Optional[int]) -> TimelinePost:
+    row = timeline_query(db).filter(MicroblogPost.id == post_id).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    return with_liked(db, [TimelinePost(**row._mapping)], viewer_id)[0]
+
+
+@api.get("/posts", response_model=TimelinePage)
+async def list_posts(
+    request: Request,
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Return one page of top-level posts, newest first"""
+    page, next_cursor = await db.run(load_timeline_page, user_id, before, limit)
+    return conditional_response(
+        request,
+        TimelinePage(posts=page, next_cursor=next_cursor),
+        weak_etag(page, next_cursor),
+        user_id
+    )
+
+
+@api.post("/posts", response_model=MicroblogOut, status_code=201)
+async def create_post_via_api(
+    post: MicroblogCreate,
+    author_id: int = Depends(get_current_user_id),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Create a post as the logged in user"""
+    if post.author_id not in (None, author_id):
+        raise HTTPException(status_code=403, detail="Can only post as yourself")
+
+    new_post_id = await db.run(
+        create_post, author_id, post.content, post.in_reply_to_post_id, post.in_reply_to_user_id
+    )
+    fanout_worker.enqueue(new_post_id)
+    if post.in_reply_to_post_id:
+        post_fragments.pop(post.in_reply_to_post_id)
+    invalidate_timelines()
+    await event_bus.publish(
+        "post_created", id=new_post_id, in_reply_to_post_id=post.in_reply_to_post_id
+    )
+    return await db.run(lambda db: db.get(MicroblogPost, new_post_id))
+
+
+@api.get("/posts/{post_id}", response_model=TimelinePostOut)
+async def get_post(
+    request: Request,
+    post_id: int,
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Return a single post"""
+    post = await db.run(load_post, post_id, user_id)
+    return conditional_response(
+        request, TimelinePostOut.model_validate(post), weak_etag([post]), user_id
+    )
+
+
+class LikeChange(BaseModel):
+    post_id: int
+    liked: bool
+
+
+class LikeBatch(BaseModel):
+    # In the order they were made, the last change of a post wins
+    likes: List[LikeChange] = Field(max_length=MAX_LIKE_BATCH)
+
+
+class LikeState(BaseModel):
+    post_id: int
+    liked: bool
+    like_count: int
+
+
+class LikeBatchOut(BaseModel):
+    likes: List[LikeState]
+    # Posts that no longer exist
+    missing: List[int]
+
+
+async def publish_likes(results: List[LikeResult]) -> None:
+    """Drop cached copies of changed posts and tell the live timelines"""
+    changed = [result for result in results if result.changed]
+    for result in changed:
+        post_fragments.pop(result.post_id)
+    if changed:
+        invalidate_timelines()
+    for result in changed:
+        await event_bus.publish("like_count", id=result.post_id, like_count=result.like_count)
+
+
+async def update_like(post_id: int, user_id: int, db: SessionRunner, action: str):
+    result = await db.run(change_like, user_id, post_id, action)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    await publish_likes([result])
+    return await db.run(load_post, post_id, user_id)
+
+
+@api.put("/posts/{post_id}/like", response_model=TimelinePostOut)
+async def like_post(
+    post_id: int,
+    user_id: int = Depends(get_current_user_id),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Like a post, return the post. Liking a liked post changes nothing"""
+    return await update_like(post_id, user_id, db, LIKE)
+
+
+@api.delete("/posts/{post_id}/like", response_model=TimelinePostOut)
+async def unlike_post(
+    post_id: int,
+    user_id: int = Depends(get_current_user_id),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Remove a like from a post, return the post"""
+    return await update_like(post_id, user_id, db, UNLIKE)
+
+
+@api.post("/likes", response_model=LikeBatchOut)
+async def change_likes_via_api(
+    batch: LikeBatch,
+    user_id: int = Depends(get_current_user_id),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Apply likes and unlikes queued up by an offline client, in one
+    transaction. Replaying a batch changes nothing"""
+    liked = {change.post_id: change.liked for change in batch.likes}
+    results = await db.run(change_likes, user_id, liked)
+    await publish_likes(results)
+    found = {result.post_id for result in results}
+    return LikeBatchOut(
+        likes=[
+            LikeState(post_id=r.post_id, liked=r.liked, like_count=r.like_count)
+            for r in results
+        ],
+        missing=[post_id for post_id in liked if post_id not in found],
+    )
+
+
+@api.get("/users/{username}/posts", response_model=TimelinePage)
+async def list_users_posts(
+    request: Request,
+    username: str,
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Return one page of a specific users posts, newest first"""
+    _, page, next_cursor = await db.run(
+        load_users_page, username, user_id, before, limit
+    )
+    return conditional_response(
+        request,
+        TimelinePage(posts=page, next_cursor=next_cursor),
+        weak_etag(page, next_cursor),
+        user_id
+    )
@@ -1,70 +1,216 @@
+# Sessions
+#
+# The session cookie is a signed token holding the user's id and name.
+# Verified tokens are kept in an LRU cache (SESSION_CACHE_SIZE tokens for
+# SESSION_CACHE_TTL seconds), so most requests neither check a signature
+# nor touch the database to know who is logged in.
+#
+# Signed tokens alone can not be taken back. With SESSION_STORE=database
+# every login is also stored server side, with an expiry, and logging out
+# deletes it. A token whose session is gone stops working once its cache
+# entry expires (at once in the worker that handled the logout).
 import os
+import secrets
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
+from itsdangerous import BadSignature, URLSafeSerializer
 from sqlalchemy.orm import Session
 
 from fastapi.requests import Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi import APIRouter, HTTPException, Cookie, Response, Depends, Form
-from passlib.hash import bcrypt
 
-from ..database import get_db
-from ..models import User
+from ..database import SessionRunner, get_async_db
+from ..lru import LRUCache
+from ..models import User, UserSession
+from ..passwords import password_hasher
 from ..template_utils import templates
+from ..timeline import UserSummary
 
 auth = APIRouter()
 
 SECRET_KEY = os.environ["SESSION_SECRET_KEY"]
+ADMIN_USERNAME = os.getenv("MICROBLOG_ADMIN_USERNAME", "admin")
+SESSION_STORE = os.getenv("SESSION_STORE", "none")
+SESSION_MAX_AGE = 60 * 60 * 24 * 30   # 30 days in seconds
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "60"))
 
-def create_session_token(user_id: int) -> str:
-    # Simple example: sign user_id with SECRET_KEY, use itsdangerous or JWT
-    from itsdangerous import URLSafeSerializer
-    s = URLSafeSerializer(SECRET_KEY)
-    return s.dumps({"user_id": user_id})
+serializer = URLSafeSerializer(SECRET_KEY)
 
-def verify_session_token(token: str) -> int:
-    from itsdangerous import URLSafeSerializer, BadSignature
-    s = URLSafeSerializer(SECRET_KEY)
+# Verified session token -> UserSummary
+verified_sessions = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+class SessionStore:
+    """Base class for server-side session stores"""
+
+    def create(self, db: Session, user_id: int) -> str:
+        """Start a session for `user_id`, return its id"""
+        raise NotImplementedError
+
+    def is_active(self, db: Session, session_id: str) -> bool:
+        """Whether the session exists and has not expired"""
+        raise NotImplementedError
+
+    def revoke(self, db: Session, session_id: str) -> None:
+        raise NotImplementedError
+
+
+class DatabaseSessionStore(SessionStore):
+    """Sessions in the user_sessions table"""
+
+    def create(self, db: Session, user_id: int) -> str:
+        now = datetime.now(timezone.utc)
+        # Clean up the user's expired sessions while at it
+        db.query(UserSession).filter(
+            UserSession.user_id == user_id, UserSession.expires_at <= now
+        ).delete(synchronize_session=False)
+        session_id = secrets.token_urlsafe(32)
+        db.add(UserSession(
+            id=session_id,
+            user_id=user_id,
+            expires_at=now + timedelta(seconds=SESSION_MAX_AGE)
+        ))
+        db.commit()
+        return session_id
+
+    def is_active(self, db: Session, session_id: str) -> bool:
+        return db.query(UserSession.id).filter(
+            UserSession.id == session_id,
+            UserSession.expires_at > datetime.now(timezone.utc)
+        ).first() is not None
+
+    def revoke(self, db: Session, session_id: str) -> None:
+        db.query(UserSession).filter(UserSession.id == session_id).delete(
+            synchronize_session=False
+        )
+        db.commit()
+
+
+def session_store_from_name(name: str) -> Optional[SessionStore]:
+    if name == "none":
+        return None
+    if name == "database":
+        return DatabaseSessionStore()
+    raise ValueError(f"Unsupported SESSION_STORE: {name}")
+
+
+session_store = session_store_from_name(SESSION_STORE)
+
+
+def create_session_token(user_id: int, username: str, session_id: Optional[str] = None) -> str:
+    data = {"user_id": user_id, "username": username}
+    if session_id is not None:
+        data["session_id"] = session_id
+    return serializer.dumps(data)
+
+
+def verify_session_token(token: str) -> dict:
     try:
-        data = s.loads(token)
-        return data["user_id"]
+        return serializer.loads(token)
     except BadSignature:
         raise HTTPException(status_code=401, detail="Invalid session")
 
-def get_current_user_id(session_token: Optional[str] = Cookie(None)) -> int:
-    if not session_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    return verify_session_token(session_token)
 
-def get_current_user_id_optional(session_token: Optional[str] = Cookie(None)) -> Optional[int]:
+def load_session_user(db: Session, data: dict) -> Optional[UserSummary]:
+    """The user of a verified token, None if its session has ended"""
+    if session_store is not None:
+        session_id = data.get("session_id")
+        if session_id is None or not session_store.is_active(db, session_id):
+            return None
+    username = data.get("username")
+    if username is None:
+        # Tokens from before the username was included
+        username = db.query(User.username).filter(User.id == data["user_id"]).scalar()
+        if username is None:
+            return None
+    return UserSummary(data["user_id"], username)
+
+
+async def get_current_user_optional(
+    session_token: Optional[str] = Cookie(None),
+    db: SessionRunner = Depends(get_async_db),
+) -> Optional[UserSummary]:
     if not session_token:
         return None
+    user = verified_sessions.get(session_token)
+    if user is not None:
+        return user
+
     try:
-        return verify_session_token(session_token)
+        data = verify_session_token(session_token)
     except HTTPException:
         return None
+    if session_store is None and "username" in data:
+        user = UserSummary(data["user_id"], data["username"])
+    else:
+        user = await db.run(load_session_user, data)
+        if user is None:
+            return None
+    verified_sessions.set(session_token, user)
+    return user
+
+
+async def get_current_user(
+    user: Optional[UserSummary] = Depends(get_current_user_optional),
+) -> UserSummary:
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user
+
+
+async def get_current_user_id(user: UserSummary = Depends(get_current_user)) -> int:
+    return user.id
+
+
+async def get_current_user_id_optional(
+    user: Optional[UserSummary] = Depends(get_current_user_optional),
+) -> Optional[int]:
+    return user.id if user else None
+
+
+async def get_admin_user_id(user: UserSummary = Depends(get_current_user)) -> int:
+    if user.username != ADMIN_USERNAME:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    return user.id
 
 
 @auth.get("/login", response_class=HTMLResponse)
-def login_form(request: Request):
+async def login_form(request: Request):
     """Render login form page"""
     return templates.TemplateResponse("login.html", {"request": request})
 
 
+def get_user_by_username(db: Session, username: str) -> Optional[User]:
+    return db.query(User).filter(User.username == username).first()
+
+
 @auth.post("/login")
-def login(
+async def login(
     request: Request,
     response: Response,
     username: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db),
+    db: SessionRunner = Depends(get_async_db),
 ):
     """If correct credentials, create token and store in session cookie"""
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not bcrypt.verify(password, user.hashed_password):
+    user = await db.run(get_user_by_username, username)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    valid, new_hash = await password_hasher.verify(password, user.hashed_password)
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # The cost factor has changed since the password was hashed
+        await db.run(update_password_hash, user.id, new_hash)
 
-    token = create_session_token(user.id)
+    session_id = None
+    if session_store is not None:
+        session_id = await db.run(session_store.create, user.id)
+    token = create_session_token(user.id, user.username, session_id)
 
     redirect_response = RedirectResponse(
         url="/posts", status_code=303
@@ -74,49 +220,69 @@ def login(
         value=token,
         httponly=True,
         secure=False,
-        max_age=60 * 60 * 24 * 30,   # 30 days in seconds
-        expires=60 * 60 * 24 * 30    # some clients require explicit expires
+        max_age=SESSION_MAX_AGE,
+        expires=SESSION_MAX_AGE    # some clients require explicit expires
     )
 
     return redirect_response
 
 
 @auth.get("/register", response_class=HTMLResponse)
-def register_form(request: Request):
+async def register_form(request: Request):
     """Render login form page"""
     return templates.TemplateResponse("register.html", {"request": request})
 
 
+def update_password_hash(db: Session, user_id: int, hashed_password: str) -> None:
+    db.query(User).filter(User.id == user_id).update({User.hashed_password: hashed_password})
+    db.commit()
+
+
+def create_user(db: Session, username: str, email: str, hashed_password: str) -> None:
+    db.add(User(
+        username=username,
+        email=email,
+        hashed_password=hashed_password
+    ))
+    db.commit()
+
+
 @auth.post("/register")
-def register(
+async def register(
     request: Request,
     response: Response,
     username: str = Form(...),
     password: str = Form(...),
     email: str = Form(...),
-    db: Session = Depends(get_db),
+    db: SessionRunner = Depends(get_async_db),
 ):
     """If correct credentials, create token and store in session cookie"""
-    user = db.query(User).filter(User.username == username).first()
+    user = await db.run(get_user_by_username, username)
     if user:
         raise HTTPException(status_code=400, detail="Username already taken")
 
-    new_user = User(
-        username=username,
-        email=email,
-        hashed_password=bcrypt.hash(password)
-    )
-
-    db.add(new_user)
-    db.commit()
+    hashed_password = await password_hasher.hash(password)
+    await db.run(create_user, username, email, hashed_password)
 
     return RedirectResponse(
         url="/auth/login", status_code=303
     )
 
 @auth.post("/logout")
-def logout():
-    """Log user out (remove cookie)"""
+async def logout(
+    session_token: Optional[str] = Cookie(None),
+    db: SessionRunner = Depends(get_async_db),
+):
+    """Log user out (remove cookie, and end the session if sessions are stored)"""
+    if session_token:
+        verified_sessions.pop(session_token)
+        if session_store is not None:
+            try:
+                session_id = verify_session_token(session_token).get("session_id")
+            except HTTPException:
+                session_id = None
+            if session_id is not None:
+                await db.run(session_store.revoke, session_id)
     response = RedirectResponse(url="/posts", status_code=303)
     response.delete_cookie("session_token")
     return response
@@ -1,23 +1,37 @@
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
-from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
 from fastapi.requests import Request
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi import APIRouter, HTTPException, Depends, Form
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi import APIRouter, HTTPException, Depends, Form, Query
 
-from .auth import get_current_user_id, get_current_user_id_optional
+from .auth import get_current_user_id, get_current_user_id_optional, get_current_user_optional
 
-from ..database import get_db
-from ..models import User, MicroblogPost, PostLike
-from ..template_utils import templates
+from ..cache import timeline_cache
+from ..counters import adjust_reply_count
+from ..database import SessionRunner, get_async_db, get_async_read_db, reads_replica
+from ..events import event_bus, event_stream
+from ..fanout import fanout_worker, load_global_timeline_page
+from ..likes import ACTIONS, TOGGLE, change_like
+from ..search import search_posts
+from ..models import User, MicroblogPost
+from ..template_utils import STREAMING_RENDER, post_fragments, stream_template, templates
+from ..threads import load_thread
+from ..writes import write_behind
+from ..timeline import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_MAX_PAGE_SIZE, PostStream, UserSummary,
+    timeline_query, with_liked
+)
 
 posts = APIRouter()
 
 # Schemas
 class MicroblogCreate(BaseModel):
-    author_id: int
+    # Defaults to the logged in user, who is the only allowed author
+    author_id: Optional[int] = None
     content: str
     in_reply_to_post_id: Optional[int] = None
     in_reply_to_user_id: Optional[int] = None
@@ -26,96 +40,232 @@ class MicroblogOut(BaseModel):
     id: int
     author_id: int
     content: str
-    created_at: str
+    created_at: datetime
     in_reply_to_post_id: Optional[int]
     in_reply_to_user_id: Optional[int]
 
     class Config:
         from_attributes = True
 
+class TimelinePostOut(MicroblogOut):
+    author_username: str
+    reply_to_username: Optional[str]
+    reply_count: int
+    like_count: int
+    liked: bool
+
+class TimelinePage(BaseModel):
+    posts: List[TimelinePostOut]
+    next_cursor: Optional[str]
+
+
+def load_timeline_page(
+    db: Session, viewer_id: Optional[int], before: Optional[str], limit: int
+):
+    """Return one page of top-level posts, and the next cursor.
+
+    Pages read from a replica are not cached: a lagging replica may miss
+    writes made before the version was bumped, and the page would be
+    served to their writers too, who read from the primary to see them.
+    """
+    version = timeline_cache.version("timelines")
+    page, next_cursor = timeline_cache.get_or_set(
+        f"posts:{version}:{before}:{limit}",
+        lambda: load_global_timeline_page(db, before, limit),
+        store=not reads_replica(db),
+    )
+    return with_liked(db, page, viewer_id), next_cursor
+
+
+def top_level_posts(db: Session):
+    return timeline_query(db).filter(MicroblogPost.in_reply_to_post_id == None)
+
+
+def invalidate_timelines() -> None:
+    timeline_cache.bump("timelines")
+
+
+@posts.get("/events")
+async def stream_events():
+    """Stream new posts, deleted posts and like counts as Server-Sent Events"""
+    return StreamingResponse(
+        event_stream(event_bus),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 @posts.get("/", response_class=HTMLResponse)
-def view_all_posts(
+async def view_all_posts(
     request: Request,
+    before: Optional[str] = None,
+    limit: int = Query(
+        DEFAULT_PAGE_SIZE, ge=1, le=STREAM_MAX_PAGE_SIZE if STREAMING_RENDER else MAX_PAGE_SIZE
+    ),
     user_id: Optional[int] = Depends(get_current_user_id_optional),
-    db: Session = Depends(get_db)
+    user_logged_in: Optional[UserSummary] = Depends(get_current_user_optional),
+    db: SessionRunner = Depends(get_async_read_db)
 ):
-    """Render page with all posts"""
-    all_posts = (
-        db.query(MicroblogPost)
-        .filter(MicroblogPost.in_reply_to_post_id == None)
-        .options(selectinload(MicroblogPost.likes))
-        .order_by(MicroblogPost.created_at.desc())
-        .all()
+    """Render page with one page of posts, newest first"""
+    if STREAMING_RENDER:
+        return stream_template(
+            "posts.html",
+            {
+                "request": request,
+                "posts": PostStream(top_level_posts, before, limit, user_id),
+                "next_cursor": None,
+                "user_id_logged_in": user_id,
+                "user_logged_in": user_logged_in
+            }
+        )
+
+    page, next_cursor = await db.run(load_timeline_page, user_id, before, limit)
+    return templates.TemplateResponse(
+        "posts.html",
+        {
+            "request": request,
+            "posts": page,
+            "next_cursor": next_cursor,
+            "user_id_logged_in": user_id,
+            "user_logged_in": user_logged_in
+        }
     )
+
+
+@posts.get("/timeline", response_model=TimelinePage)
+async def view_timeline_json(
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Return one page of posts as JSON, newest first"""
+    page, next_cursor = await db.run(load_timeline_page, user_id, before, limit)
+    return TimelinePage(posts=page, next_cursor=next_cursor)
+
+
+def load_search_page(
+    db: Session, q: str, viewer_id: Optional[int], before: Optional[str], limit: int
+):
+    page, next_cursor = search_posts(db, q, before, limit)
+    return with_liked(db, page, viewer_id), next_cursor
+
+
+@posts.get("/search", response_class=HTMLResponse)
+async def view_search_results(
+    request: Request,
+    q: str = "",
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    user_logged_in: Optional[UserSummary] = Depends(get_current_user_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Render page with posts matching the search query `q`"""
+    page, next_cursor = await db.run(load_search_page, q, user_id, before, limit)
     return templates.TemplateResponse(
         "posts.html",
         {
             "request": request,
-            "posts": all_posts,
+            "query": q,
+            "posts": page,
+            "next_cursor": next_cursor,
             "user_id_logged_in": user_id,
-            "user_logged_in": db.query(User).get(user_id) if user_id else None
+            "user_logged_in": user_logged_in
         }
     )
 
 
+@posts.get("/search.json", response_model=TimelinePage)
+async def view_search_results_json(
+    q: str = "",
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Return posts matching the search query `q` as JSON, best match first"""
+    page, next_cursor = await db.run(load_search_page, q, user_id, before, limit)
+    return TimelinePage(posts=page, next_cursor=next_cursor)
+
+
 @posts.get("/{post_id}", response_class=HTMLResponse)
-def view_single_posts(
+async def view_single_posts(
     request: Request,
     post_id: int,
+    after: Optional[str] = None,
     user_id: Optional[int] = Depends(get_current_user_id_optional),
-    db: Session = Depends(get_db)
+    user_logged_in: Optional[UserSummary] = Depends(get_current_user_optional),
+    db: SessionRunner = Depends(get_async_read_db)
 ):
-    """Render page with single post"""
-    post = db.query(MicroblogPost).filter_by(id=post_id).first()
+    """Render page with single post and its thread"""
+    thread = await db.run(load_thread, post_id, user_id, after)
     return templates.TemplateResponse(
         "post.html",
         {
             "request": request,
-            "post": post,
+            "thread": thread,
             "user_id_logged_in": user_id,
-            "user_logged_in": db.query(User).get(user_id) if user_id else None
+            "user_logged_in": user_logged_in
         }
     )
 
 
-@posts.post("/create")
-def create_post_via_form(
-    request: Request,
-    author_id: int = Depends(get_current_user_id),
-    content: str = Form(...),
-    in_reply_to_post_id: Optional[str] = Form(None),
-    in_reply_to_user_id: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
-):
-    """Create posts from submitted form"""
+def create_post(
+    db: Session,
+    author_id: int,
+    content: str,
+    in_reply_to_post_id: Optional[int],
+    in_reply_to_user_id: Optional[int],
+) -> int:
+    """Create a post and return its id"""
     user = db.query(User).filter(User.id == author_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Convert empty strings to None, otherwise cast to int
-    post_id = int(in_reply_to_post_id) if in_reply_to_post_id else None
-    user_id = int(in_reply_to_user_id) if in_reply_to_user_id else None
-
     new_post = MicroblogPost(
         author_id=author_id,
         content=content,
-        in_reply_to_post_id=post_id,
-        in_reply_to_user_id=user_id,
+        in_reply_to_post_id=in_reply_to_post_id,
+        in_reply_to_user_id=in_reply_to_user_id,
     )
     db.add(new_post)
+    if in_reply_to_post_id:
+        adjust_reply_count(db, in_reply_to_post_id, 1)
     db.commit()
-    return RedirectResponse(url=f"/posts/{new_post.id}", status_code=303)
+    return new_post.id
 
 
-@posts.post("/delete")
-def delete_post_via_form(
+@posts.post("/create")
+async def create_post_via_form(
     request: Request,
     author_id: int = Depends(get_current_user_id),
-    post_id: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
+    content: str = Form(...),
+    in_reply_to_post_id: Optional[str] = Form(None),
+    in_reply_to_user_id: Optional[str] = Form(None),
+    db: SessionRunner = Depends(get_async_db),
 ):
-    """Delete posts from submitted form"""
+    """Create posts from submitted form"""
+    # Convert empty strings to None, otherwise cast to int
+    post_id = int(in_reply_to_post_id) if in_reply_to_post_id else None
+    user_id = int(in_reply_to_user_id) if in_reply_to_user_id else None
+
+    new_post_id = await write_behind.create_post((author_id, content, post_id, user_id))
+    if new_post_id is None:
+        new_post_id = await db.run(create_post, author_id, content, post_id, user_id)
+    fanout_worker.enqueue(new_post_id)
+    if post_id:
+        post_fragments.pop(post_id)
+    invalidate_timelines()
+    await event_bus.publish("post_created", id=new_post_id, in_reply_to_post_id=post_id)
+    return RedirectResponse(url=f"/posts/{new_post_id}", status_code=303)
+
+
+def delete_post(db: Session, author_id: int, post_id: Optional[str]) -> List[int]:
+    """Delete a post, if it exists and was written by `author_id`.
+
+    Returns the ids of the deleted post and the post it replied to.
+    """
     user = db.query(User).filter(User.id == author_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -125,44 +275,58 @@ def delete_post_via_form(
         MicroblogPost.author_id == author_id
     ).first()
 
-    if post:
-        db.delete(post)
-        db.commit()
+    if not post:
+        return []
+
+    changed = [post.id]
+    if post.in_reply_to_post_id:
+        adjust_reply_count(db, post.in_reply_to_post_id, -1)
+        changed.append(post.in_reply_to_post_id)
+    db.delete(post)
+    db.commit()
+    return changed
+
 
+@posts.post("/delete")
+async def delete_post_via_form(
+    request: Request,
+    author_id: int = Depends(get_current_user_id),
+    post_id: Optional[str] = Form(None),
+    db: SessionRunner = Depends(get_async_db),
+):
+    """Delete posts from submitted form"""
+    changed = await db.run(delete_post, author_id, post_id)
+    for changed_post_id in changed:
+        post_fragments.pop(changed_post_id)
+    if changed:
+        invalidate_timelines()
+        await event_bus.publish("post_deleted", id=changed[0])
     return RedirectResponse(url="/posts", status_code=303)
 
 
 @posts.post("/like")
-def like_post_via_form(
+async def like_post_via_form(
     request: Request,
     liked_by: int = Depends(get_current_user_id),
     post_id: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
+    action: str = Form(TOGGLE),
+    db: SessionRunner = Depends(get_async_db),
 ):
-    """Create like from submitted form"""
-    user = db.query(User).filter(User.id == liked_by).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    post = db.query(MicroblogPost).filter(
-        MicroblogPost.id == post_id
-    ).first()
+    """Like or unlike a post from submitted form.
 
-    like = db.query(PostLike).filter(
-        PostLike.post_id == post_id,
-        PostLike.user_id == liked_by
-    ).first()
-
-    if post and not like:
-        # Create like if post exists but like does not
-        like = PostLike(
-            post_id=post_id,
-            user_id=liked_by
-        )
-        db.add(like)
-        db.commit()
-    elif post and like:
-        db.delete(like)
-        db.commit()
+    The form says whether to like or unlike, so submitting it twice
+    does not undo the first submit. Without an action the like is toggled.
+    """
+    if action not in ACTIONS:
+        raise HTTPException(status_code=400, detail="Unknown action")
+    if post_id is None or not post_id.isdigit():
+        return RedirectResponse(url="/posts", status_code=303)
+    if write_behind.like(liked_by, int(post_id), action):
+        return RedirectResponse(url="/posts", status_code=303)
 
+    result = await db.run(change_like, liked_by, int(post_id), action)
+    if result is not None and result.changed:
+        post_fragments.pop(result.post_id)
+        invalidate_timelines()
+        await event_bus.publish("like_count", id=result.post_id, like_count=result.like_count)
     return RedirectResponse(url="/posts", status_code=303)
@@ -4,48 +4,120 @@ from sqlalchemy.orm import Session
 
 from fastapi.requests import Request
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 
-from .auth import get_current_user_id_optional
+from .auth import get_current_user_id_optional, get_current_user_optional
+from .posts import TimelinePage
 
-from ..database import get_db
+from ..cache import timeline_cache
+from ..database import SessionRunner, get_async_db, get_async_read_db, reads_replica
 from ..models import User, MicroblogPost
-from ..template_utils import templates
+from ..template_utils import STREAMING_RENDER, stream_template, templates
+from ..timeline import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_MAX_PAGE_SIZE, PostStream, UserSummary, paginate,
+    timeline_query, with_liked
+)
 
 users = APIRouter()
 
 @users.get("/", response_class=HTMLResponse)
-def view_all_users(
+async def view_all_users(
     request: Request,
 ):
     """Render page with all posts"""
     return RedirectResponse('/posts')
 
 
+def get_user_summary(db: Session, username: str) -> UserSummary:
+    user = db.query(User).filter(User.username == username).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return UserSummary(user.id, user.username)
+
+
+def load_users_page(
+    db: Session,
+    username: str,
+    viewer_id: Optional[int],
+    before: Optional[str],
+    limit: int,
+):
+    """Return a user and one page of their posts, and the next cursor"""
+    def load():
+        user = get_user_summary(db, username)
+        page, next_cursor = paginate(
+            timeline_query(db).filter(MicroblogPost.author_id == user.id),
+            before,
+            limit
+        )
+        return user, page, next_cursor
+
+    version = timeline_cache.version("timelines")
+    # Not cached from a replica, see load_timeline_page
+    user, page, next_cursor = timeline_cache.get_or_set(
+        f"user:{version}:{username}:{before}:{limit}", load, store=not reads_replica(db)
+    )
+    return user, with_liked(db, page, viewer_id), next_cursor
+
+
 @users.get("/{username}", response_class=HTMLResponse)
-def view_users_posts(
+async def view_users_posts(
     request: Request,
     username: str,
+    before: Optional[str] = None,
+    limit: int = Query(
+        DEFAULT_PAGE_SIZE, ge=1, le=STREAM_MAX_PAGE_SIZE if STREAMING_RENDER else MAX_PAGE_SIZE
+    ),
     user_id: Optional[int] = Depends(get_current_user_id_optional),
-    db: Session = Depends(get_db)
+    user_logged_in: Optional[UserSummary] = Depends(get_current_user_optional),
+    db: SessionRunner = Depends(get_async_read_db)
 ):
-    """Render page with a specific users posts"""
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    """Render page with one page of a specific users posts"""
+    if STREAMING_RENDER:
+        user = await db.run(get_user_summary, username)
+        return stream_template(
+            "posts.html",
+            {
+                "by_user": user,
+                "request": request,
+                "posts": PostStream(
+                    lambda db: timeline_query(db).filter(MicroblogPost.author_id == user.id),
+                    before,
+                    limit,
+                    user_id
+                ),
+                "next_cursor": None,
+                "user_id_logged_in": user_id,
+                "user_logged_in": user_logged_in
+            }
+        )
 
-    all_posts = (
-        db.query(MicroblogPost)
-        .order_by(MicroblogPost.created_at.desc())
-        .filter(MicroblogPost.author_id == user.id)
-        .all()
+    user, page, next_cursor = await db.run(
+        load_users_page, username, user_id, before, limit
     )
     return templates.TemplateResponse(
         "posts.html",
         {
             "by_user": user,
             "request": request,
-            "posts": all_posts,
-            "user_logged_in": user_id
+            "posts": page,
+            "next_cursor": next_cursor,
+            "user_id_logged_in": user_id,
+            "user_logged_in": user_logged_in
         }
     )
+
+
+@users.get("/{username}/timeline", response_model=TimelinePage)
+async def view_users_timeline_json(
+    username: str,
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = Depends(get_current_user_id_optional),
+    db: SessionRunner = Depends(get_async_db)
+):
+    """Return one page of a specific users posts as JSON"""
+    _, page, next_cursor = await db.run(
+        load_users_page, username, user_id, before, limit
+    )
+    return TimelinePage(posts=page, next_cursor=next_cursor)
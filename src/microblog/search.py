@@ -0,0 +1,122 @@
+# search.py
+#
+# Full-text search over posts. On Postgres posts have a generated
+# search_vector column with a GIN index. Other databases (SQLite, for
+# local development and tests) use an FTS5 table instead, which is
+# brought up to date when searching rather than when posting.
+import base64
+import binascii
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func, literal_column, select, text, tuple_
+from sqlalchemy.orm import Session
+
+from fastapi import HTTPException
+
+from .models import MicroblogPost
+from .timeline import TimelinePost, timeline_query
+
+# Text search configuration, 'simple' does not assume a language
+SEARCH_CONFIG = "simple"
+
+
+def encode_search_cursor(rank: float, post_id: int) -> str:
+    raw = f"{rank!r}|{post_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, post_id = base64.urlsafe_b64decode(padded).decode().split("|")
+        return float(rank), int(post_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def postgres_matches(q: str):
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    vector = literal_column("microblog_posts.search_vector")
+    return (
+        select(
+            MicroblogPost.id.label("post_id"),
+            func.ts_rank(vector, query).label("rank"),
+        )
+        .where(vector.op("@@")(query))
+        .subquery("matches")
+    )
+
+
+def update_sqlite_index(db: Session) -> None:
+    """Add posts created since the last search to the FTS5 index.
+
+    Deleted posts stay in the index, but are dropped from results by the
+    join with microblog_posts.
+    """
+    db.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS microblog_posts_fts "
+        "USING fts5(content, content='')"
+    ))
+    db.execute(text(
+        "INSERT INTO microblog_posts_fts (rowid, content) "
+        "SELECT id, content FROM microblog_posts "
+        "WHERE id > coalesce((SELECT max(rowid) FROM microblog_posts_fts), 0)"
+    ))
+    db.commit()
+
+
+def sqlite_matches(q: str):
+    # Quote every word, so FTS5 query syntax in the input is taken literally
+    terms = " ".join('"' + word.replace('"', '""') + '"' for word in q.split())
+    fts = literal_column("microblog_posts_fts")
+    return (
+        select(
+            literal_column("microblog_posts_fts.rowid").label("post_id"),
+            (-func.bm25(fts)).label("rank"),
+        )
+        .select_from(text("microblog_posts_fts"))
+        .where(fts.op("MATCH")(terms))
+        .subquery("matches")
+    )
+
+
+def search_posts(
+    db: Session, q: str, before: Optional[str], limit: int
+) -> Tuple[List[TimelinePost], Optional[str]]:
+    """Return one page of posts matching `q`, best match first, and the
+    cursor for the next page"""
+    if not q.strip():
+        return [], None
+
+    if db.get_bind().dialect.name == "postgresql":
+        matches = postgres_matches(q)
+    else:
+        update_sqlite_index(db)
+        matches = sqlite_matches(q)
+
+    query = (
+        timeline_query(db)
+        .add_columns(matches.c.rank)
+        .join(matches, matches.c.post_id == MicroblogPost.id)
+    )
+    if before:
+        rank, post_id = decode_search_cursor(before)
+        query = query.filter(tuple_(matches.c.rank, MicroblogPost.id) < tuple_(rank, post_id))
+
+    rows = (
+        query
+        .order_by(matches.c.rank.desc(), MicroblogPost.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1].rank, rows[-1].id)
+
+    posts = [
+        TimelinePost(**{key: value for key, value in row._mapping.items() if key != "rank"})
+        for row in rows
+    ]
+    return posts, next_cursor
@@ -1,25 +1,213 @@
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+import asyncio
 import os
+from typing import Dict, Iterable, List, Optional
 
+import anyio
+import anyio.from_thread
+import anyio.to_thread
+from fastapi.responses import StreamingResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup, escape
+
+from .lru import LRUCache
+
+# Rendered single_post.html fragments, keyed by post id
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", "10000"))
+FRAGMENT_CACHE_TTL = float(os.getenv("FRAGMENT_CACHE_TTL", "600"))
+
+# Keep compiled templates on disk, so new workers do not compile them
+# again. Fill the cache ahead of time with `microblog compile-templates`.
+TEMPLATE_BYTECODE_CACHE = os.getenv("TEMPLATE_BYTECODE_CACHE", "true").lower() == "true"
+# Defaults to a directory per user in the temp directory
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR") or None
+
+# Stream HTML timelines to the client while they are rendered
+STREAMING_RENDER = os.getenv("STREAMING_RENDER", "false").lower() == "true"
+# Rendered pieces of a streamed page that may wait for a slow client
+STREAM_QUEUE_SIZE = 256
+# Streamed pages rendered at once. Their renderers wait for slow clients,
+# so they get threads of their own rather than tokens of the threadpool
+# that request handlers run database work in.
+STREAM_MAX_RENDERERS = int(os.getenv("STREAM_MAX_RENDERERS", "20"))
+stream_renderers = anyio.CapacityLimiter(STREAM_MAX_RENDERERS)
+
+# Absolute times of posts older than a day, which never change
+TIME_CACHE_SIZE = int(os.getenv("TIME_CACHE_SIZE", "10000"))
+absolute_times = LRUCache(TIME_CACHE_SIZE)
+
+ABSOLUTE_TIME_FORMAT = "%a %b %-d, %Y %H:%M"
+
+
+class TimestampFormatter:
+    """Formats times relative to one `now`, so every post of a page is
+    formatted against the same clock. Formatted times are remembered, a
+    formatter should not outlive the request it was made for."""
+
+    def __init__(self, now: Optional[datetime] = None):
+        self.now = now or datetime.now(timezone.utc)
+        # SQLite does not store time zones, its timestamps are naive UTC
+        self.now_naive = self.now.astimezone(timezone.utc).replace(tzinfo=None)
+        self.labels: Dict[datetime, str] = {}
+
+    def format(self, dt: datetime) -> str:
+        label = self.labels.get(dt)
+        if label is None:
+            label = self.format_all([dt])[0]
+        return label
+
+    def format_all(self, dts: Iterable[datetime]) -> List[str]:
+        """Format many times at once. Most posts of a page are older than a
+        day, their absolute times are looked up in the cache together."""
+        dts = list(dts)
+        labels = self.labels
+        relative = {}
+        for dt in dts:
+            seconds = ((self.now_naive if dt.tzinfo is None else self.now) - dt).total_seconds()
+            if seconds < 60:
+                relative[dt] = "now"
+            elif seconds < 60 * 60:
+                relative[dt] = f"{int(seconds // 60)} min ago"
+            elif seconds < 24 * 60 * 60:
+                relative[dt] = f"{int(seconds // 3600)}h ago"
+        labels.update(relative)
+
+        absolute = [dt for dt in dts if dt not in relative]
+        found = absolute_times.get_many(absolute)
+        labels.update(found)
+        for dt in absolute:
+            if dt not in found:
+                label = labels[dt] = dt.strftime(ABSOLUTE_TIME_FORMAT)
+                absolute_times.set(dt, label)
+        return [labels[dt] for dt in dts]
+
 
 def format_datetime(dt: datetime) -> str:
-    now = datetime.now(timezone.utc)
-    delta = now - dt
-
-    if delta < timedelta(minutes=1):
-        return "now"
-    elif delta < timedelta(hours=1):
-        minutes = int(delta.total_seconds() // 60)
-        return f"{minutes} min ago"
-    elif delta < timedelta(days=1):
-        hours = int(delta.total_seconds() // 3600)
-        return f"{hours}h ago"
-    else:
-        return dt.strftime("%a %b %-d, %Y %H:%M")
+    return TimestampFormatter().format(dt)
+
+
+def page_timestamps(context) -> TimestampFormatter:
+    """The formatter of the request being rendered, made on first use"""
+    request = context.get("request")
+    if request is None:
+        return TimestampFormatter()
+    formatter = getattr(request.state, "timestamps", None)
+    if formatter is None:
+        formatter = request.state.timestamps = TimestampFormatter()
+    return formatter
+
+
+@pass_context
+def format_post_times(context, posts) -> str:
+    """Format the times of a list of posts in one go, before they are
+    rendered. Streamed pages (PostStream) are left alone, iterating them
+    here would read them from the database twice."""
+    if isinstance(posts, list):
+        page_timestamps(context).format_all(post.created_at for post in posts)
+    return ""
+
 
 template_path = os.path.join(
     os.path.dirname(__file__), 'templates'
 )
 templates = Jinja2Templates(directory=template_path)
 templates.env.filters["format_datetime"] = format_datetime
+if TEMPLATE_BYTECODE_CACHE:
+    if TEMPLATE_CACHE_DIR:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    templates.env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
+def compile_templates() -> int:
+    """Compile all templates into the bytecode cache, return how many"""
+    names = templates.env.list_templates(extensions=["html"])
+    for name in names:
+        templates.env.get_template(name)
+    return len(names)
+
+post_fragments = LRUCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+
+
+def post_version(post) -> tuple:
+    """The fields of a post row that can change after it was written"""
+    return (post.like_count, post.reply_count, post.in_reply_to_post_id)
+
+
+@pass_context
+def render_post(context, post, user_id_logged_in, user_logged_in) -> Markup:
+    """Render single_post.html for a timeline row, reusing cached fragments.
+
+    The cached fragment is the same for every viewer. The relative time
+    (against the same `now` for the whole request) and the viewer dependent parts from post_viewer.html are filled in
+    afterwards. Writes call `post_fragments.pop` for the posts they
+    change, the version check guards against anything that was missed.
+    """
+    cached = post_fragments.get(post.id)
+    if cached is not None and cached[0] == post_version(post):
+        html = cached[1]
+    else:
+        html = templates.get_template("single_post.html").render(post=post)
+        post_fragments.set(post.id, (post_version(post), html))
+
+    viewer = templates.get_template("post_viewer.html").module
+    return Markup(
+        html
+        .replace("<!--post-time-->", escape(page_timestamps(context).format(post.created_at)))
+        .replace("<!--post-reply-button-->", viewer.reply_button(post) if user_logged_in else "")
+        .replace("<!--post-liked-->", viewer.liked(post))
+        .replace("<!--post-like-action-->", viewer.like_action(post))
+        .replace(
+            "<!--post-delete-form-->",
+            viewer.delete_form(post) if user_id_logged_in == post.author_id else ""
+        )
+    )
+
+
+templates.env.globals["render_post"] = render_post
+templates.env.globals["format_post_times"] = format_post_times
+
+
+def stream_template(name: str, context: dict) -> StreamingResponse:
+    """Render a template with Jinja's generate() and send it as it is rendered.
+
+    The template is rendered in a worker thread, since values in the
+    context (like a PostStream) may read from the database while they are
+    iterated. Whatever has been rendered is flushed whenever the renderer
+    waits, so the page head is sent before the first posts are loaded.
+    The stream between the two is bounded, so a slow client holds back the
+    renderer instead of buffering the whole page.
+    """
+    template = templates.get_template(name)
+
+    async def body():
+        send, receive = anyio.create_memory_object_stream(STREAM_QUEUE_SIZE)
+
+        def render():
+            with send:
+                try:
+                    for chunk in template.generate(context):
+                        # Waits while the stream is full
+                        anyio.from_thread.run(send.send, chunk)
+                except anyio.BrokenResourceError:
+                    # The client went away
+                    pass
+
+        renderer = asyncio.ensure_future(
+            anyio.to_thread.run_sync(render, limiter=stream_renderers)
+        )
+        with receive:
+            async for chunk in receive:
+                # Take whatever else is ready too
+                pieces = [chunk]
+                while True:
+                    try:
+                        pieces.append(receive.receive_nowait())
+                    except (anyio.WouldBlock, anyio.EndOfStream):
+                        break
+                yield "".join(pieces)
+        # Raise errors from the renderer. When the client goes away first,
+        # closing `receive` stops the renderer at its next chunk.
+        await renderer
+
+    return StreamingResponse(body(), media_type="text/html")
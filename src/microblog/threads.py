@@ -0,0 +1,146 @@
+# threads.py
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from sqlalchemy import literal, select, tuple_, union_all
+from sqlalchemy.orm import Session, aliased
+
+from fastapi import HTTPException
+
+from .models import MicroblogPost
+from .timeline import TimelinePost, decode_cursor, encode_cursor, timeline_query, with_liked
+
+# Levels of replies below the viewed post
+THREAD_MAX_DEPTH = int(os.getenv("THREAD_MAX_DEPTH", "6"))
+# Replies loaded for the whole thread
+THREAD_MAX_POSTS = int(os.getenv("THREAD_MAX_POSTS", "200"))
+# Replies shown below a single post, the rest are behind a link
+THREAD_MAX_CHILDREN = int(os.getenv("THREAD_MAX_CHILDREN", "20"))
+# Posts shown above the viewed post, from the one it replies to and up
+THREAD_MAX_ANCESTORS = int(os.getenv("THREAD_MAX_ANCESTORS", "20"))
+
+@dataclass
+class ThreadNode:
+    post: TimelinePost
+    children: List["ThreadNode"] = field(default_factory=list)
+    # Link to the replies that did not fit, if any
+    more_replies_url: Optional[str] = None
+
+
+@dataclass
+class Thread:
+    ancestors: List[TimelinePost]
+    root: ThreadNode
+
+
+def thread_ids(post_id: int, after: Optional[str], max_depth: int):
+    """Recursive CTEs selecting (id, depth) for a post's thread.
+
+    Ancestors get negative depths, the post itself 0 and replies positive
+    depths. `after` is a cursor that skips the post's direct replies up
+    to and including the one it points at.
+    """
+    parent = aliased(MicroblogPost)
+    ancestors = (
+        select(
+            MicroblogPost.id.label("id"),
+            MicroblogPost.in_reply_to_post_id.label("parent_id"),
+            literal(0).label("depth"),
+        )
+        .where(MicroblogPost.id == post_id)
+        .cte("ancestors", recursive=True)
+    )
+    ancestors = ancestors.union_all(
+        select(parent.id, parent.in_reply_to_post_id, ancestors.c.depth - 1)
+        .where(
+            parent.id == ancestors.c.parent_id,
+            ancestors.c.depth > -THREAD_MAX_ANCESTORS
+        )
+    )
+
+    child = aliased(MicroblogPost)
+    descendants = (
+        select(MicroblogPost.id.label("id"), literal(0).label("depth"))
+        .where(MicroblogPost.id == post_id)
+        .cte("descendants", recursive=True)
+    )
+    step = select(child.id, descendants.c.depth + 1).where(
+        child.in_reply_to_post_id == descendants.c.id,
+        descendants.c.depth < max_depth
+    )
+    if after:
+        created_at, reply_id = decode_cursor(after)
+        step = step.where(
+            (descendants.c.depth > 0)
+            | (tuple_(child.created_at, child.id) > tuple_(created_at, reply_id))
+        )
+    descendants = descendants.union_all(step)
+
+    return union_all(
+        select(ancestors.c.id, ancestors.c.depth).where(ancestors.c.depth < 0),
+        select(descendants.c.id, descendants.c.depth),
+    ).subquery("thread")
+
+
+def load_thread(
+    db: Session,
+    post_id: int,
+    viewer_id: Optional[int],
+    after: Optional[str] = None,
+) -> Thread:
+    """Load a post, its ancestors and a bounded window of its replies.
+
+    The whole thread is fetched with a single statement, plus one for the
+    viewer's likes, and assembled into a tree of ThreadNodes. Replies are
+    loaded breadth first, so when a thread is larger than the window it
+    is the deepest and latest replies that are left out.
+    """
+    thread = thread_ids(post_id, after, THREAD_MAX_DEPTH)
+    rows = (
+        timeline_query(db)
+        .add_columns(thread.c.depth)
+        .join(thread, thread.c.id == MicroblogPost.id)
+        .order_by(thread.c.depth, MicroblogPost.created_at, MicroblogPost.id)
+        .limit(THREAD_MAX_ANCESTORS + 1 + THREAD_MAX_POSTS)
+        .all()
+    )
+
+    depths = [row.depth for row in rows]
+    posts = with_liked(
+        db,
+        [
+            TimelinePost(**{key: value for key, value in row._mapping.items() if key != "depth"})
+            for row in rows
+        ],
+        viewer_id
+    )
+
+    nodes: Dict[int, ThreadNode] = {}
+    ancestors = []
+    root = None
+    for depth, post in zip(depths, posts):
+        if depth < 0:
+            ancestors.append(post)
+            continue
+        node = nodes[post.id] = ThreadNode(post)
+        if depth == 0:
+            root = node
+        elif post.in_reply_to_post_id in nodes:
+            nodes[post.in_reply_to_post_id].children.append(node)
+
+    if root is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+
+    for node in nodes.values():
+        shown = node.children[:THREAD_MAX_CHILDREN]
+        if node is root and len(node.children) > len(shown):
+            # Direct replies to the viewed post are paged with a cursor
+            last = shown[-1].post
+            cursor = encode_cursor(last.created_at, last.id)
+            node.more_replies_url = f"/posts/{node.post.id}?after={cursor}"
+        elif node is not root and node.post.reply_count > len(shown):
+            node.more_replies_url = f"/posts/{node.post.id}"
+        node.children = shown
+
+    return Thread(ancestors=ancestors, root=root)
@@ -0,0 +1,201 @@
+# timeline.py
+import base64
+import binascii
+import os
+from dataclasses import dataclass, replace
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import Query, Session, aliased
+
+from fastapi import HTTPException
+
+from .database import SessionLocal
+from .models import MicroblogPost, PostLike, User
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Largest page of a streamed HTML timeline, see PostStream
+STREAM_MAX_PAGE_SIZE = int(os.getenv("STREAM_MAX_PAGE_SIZE", "1000"))
+# Posts fetched from the database cursor at a time when streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "50"))
+
+
+def encode_cursor(created_at: datetime, post_id: int) -> str:
+    """Encode the position of a post as an opaque cursor string"""
+    raw = f"{created_at.isoformat()}|{post_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode a cursor created by `encode_cursor`"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, post_id = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@dataclass
+class TimelinePost:
+    """A post as rendered by single_post.html"""
+    id: int
+    author_id: int
+    author_username: str
+    content: str
+    created_at: datetime
+    in_reply_to_post_id: Optional[int]
+    in_reply_to_user_id: Optional[int]
+    reply_to_username: Optional[str]
+    reply_count: int
+    like_count: int
+    liked: bool = False
+
+
+@dataclass
+class UserSummary:
+    id: int
+    username: str
+
+
+def timeline_query(db: Session) -> Query:
+    """Query for posts as flat rows, see `fetch_posts`
+
+    Author, replied-to author and the reply and like counters are all
+    fetched in the same statement, so rendering a page of posts never
+    triggers lazy loads. The rows do not depend on who is viewing them,
+    so they can be cached and shared between viewers.
+    """
+    reply_to = aliased(MicroblogPost)
+    reply_to_author = aliased(User)
+
+    return (
+        db.query(
+            MicroblogPost.id,
+            MicroblogPost.author_id,
+            User.username.label("author_username"),
+            MicroblogPost.content,
+            MicroblogPost.created_at,
+            MicroblogPost.in_reply_to_post_id,
+            MicroblogPost.in_reply_to_user_id,
+            reply_to_author.username.label("reply_to_username"),
+            MicroblogPost.reply_count,
+            MicroblogPost.like_count,
+        )
+        .join(User, User.id == MicroblogPost.author_id)
+        .outerjoin(reply_to, reply_to.id == MicroblogPost.in_reply_to_post_id)
+        .outerjoin(reply_to_author, reply_to_author.id == reply_to.author_id)
+    )
+
+
+def fetch_posts(query: Query) -> List[TimelinePost]:
+    return [TimelinePost(**row._mapping) for row in query]
+
+
+def with_liked(
+    db: Session, posts: List[TimelinePost], viewer_id: Optional[int]
+) -> List[TimelinePost]:
+    """Return copies of `posts` with `liked` set for the viewer.
+
+    Costs one statement for the whole page, and leaves `posts` untouched
+    since they may be shared through a cache.
+    """
+    liked_ids = set()
+    if viewer_id is not None and posts:
+        liked_ids = set(db.scalars(
+            select(PostLike.post_id).where(
+                PostLike.user_id == viewer_id,
+                PostLike.post_id.in_([post.id for post in posts])
+            )
+        ))
+    return [replace(post, liked=post.id in liked_ids) for post in posts]
+
+
+def paginate(
+    query: Query,
+    before: Optional[str],
+    limit: int,
+    keyset: tuple = (MicroblogPost.created_at, MicroblogPost.id),
+) -> Tuple[List[TimelinePost], Optional[str]]:
+    """Return one page of posts older than `before`, and the next cursor.
+
+    Pages are selected with a (created_at, id) keyset instead of OFFSET,
+    so fetching a page costs the same no matter how deep into the
+    timeline it is. `keyset` are the columns holding the post's
+    created_at and id to filter and sort on.
+    """
+    created_at_column, id_column = keyset
+    if before:
+        created_at, post_id = decode_cursor(before)
+        query = query.filter(
+            tuple_(created_at_column, id_column) < tuple_(created_at, post_id)
+        )
+
+    page = fetch_posts(
+        query
+        .order_by(created_at_column.desc(), id_column.desc())
+        .limit(limit + 1)
+    )
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        next_cursor = encode_cursor(last.created_at, last.id)
+
+    return page, next_cursor
+
+
+class PostStream:
+    """One page of posts that is read from the database while it is
+    iterated, for streamed rendering (see `stream_template`).
+
+    Rows come from a server-side cursor in batches of STREAM_BATCH_SIZE,
+    so only one batch is held in memory. The stream opens its own
+    session, since the response is rendered after the request's session
+    has been closed. `next_cursor` is set once the page has been iterated.
+    """
+
+    def __init__(
+        self,
+        build_query: Callable[[Session], Query],
+        before: Optional[str],
+        limit: int,
+        viewer_id: Optional[int],
+    ):
+        self.build_query = build_query
+        # Decoded up front, so an invalid cursor fails before streaming
+        self.before = decode_cursor(before) if before else None
+        self.limit = limit
+        self.viewer_id = viewer_id
+        self.next_cursor: Optional[str] = None
+
+    def __iter__(self) -> Iterator[TimelinePost]:
+        db = SessionLocal()
+        try:
+            query = self.build_query(db)
+            if self.before:
+                query = query.filter(
+                    tuple_(MicroblogPost.created_at, MicroblogPost.id) < tuple_(*self.before)
+                )
+            statement = (
+                query
+                .order_by(MicroblogPost.created_at.desc(), MicroblogPost.id.desc())
+                .limit(self.limit + 1)
+                .statement
+                .execution_options(yield_per=STREAM_BATCH_SIZE)
+            )
+            count = 0
+            for rows in db.execute(statement).partitions():
+                batch = [TimelinePost(**row._mapping) for row in rows]
+                for post in with_liked(db, batch, self.viewer_id):
+                    if count == self.limit:
+                        self.next_cursor = encode_cursor(last.created_at, last.id)
+                        return
+                    count += 1
+                    last = post
+                    yield post
+        finally:
+            db.close()
@@ -0,0 +1,223 @@
+# writes.py
+#
+# Optional batching of writes, enabled with WRITE_BEHIND=true. Instead of
+# one transaction (and one fsync) per request, new posts and likes are
+# handed to a background worker that commits them in batches.
+#
+# A batch is committed at most WRITE_BEHIND_DELAY_MS after its first
+# write arrived, or as soon as WRITE_BEHIND_BATCH_SIZE writes are waiting.
+#
+# Durability differs between the two kinds of writes:
+#
+# - Posts are group committed: the request waits until the batch with
+#   its post is committed, so an answered request is as durable as before.
+# - Likes are write-behind: the request is answered as soon as the like is
+#   queued, and queued likes are lost if the process is killed before the
+#   next commit. Likes and unlikes of the same post by the same user
+#   waiting in the queue are coalesced into one change.
+#
+# Beyond WRITE_BEHIND_MAX_PENDING waiting writes, or while shutting down,
+# requests write synchronously again. Shutdown commits everything queued.
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from .cache import timeline_cache
+from .counters import adjust_reply_count
+from .database import SessionLocal
+from .events import event_bus
+from .likes import LIKE, TOGGLE, UNLIKE, LikeResult, apply_like
+from .models import MicroblogPost
+from .template_utils import post_fragments
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_DELAY_MS = float(os.getenv("WRITE_BEHIND_DELAY_MS", "20"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+
+# (author_id, content, in_reply_to_post_id, in_reply_to_user_id)
+NewPost = Tuple[int, str, Optional[int], Optional[int]]
+
+
+def combine_like_actions(previous: Optional[str], action: str) -> Optional[str]:
+    """The single action with the effect of `previous` followed by `action`.
+
+    None means no change, e.g. after toggling twice.
+    """
+    if action != TOGGLE:
+        return action
+    if previous is None:
+        return TOGGLE
+    return {TOGGLE: None, LIKE: UNLIKE, UNLIKE: LIKE}[previous]
+
+
+def insert_posts(db: Session, posts: List[NewPost]) -> List[int]:
+    """Insert posts in one transaction, return their ids"""
+    new_posts = [
+        MicroblogPost(
+            author_id=author_id,
+            content=content,
+            in_reply_to_post_id=in_reply_to_post_id,
+            in_reply_to_user_id=in_reply_to_user_id,
+        )
+        for author_id, content, in_reply_to_post_id, in_reply_to_user_id in posts
+    ]
+    db.add_all(new_posts)
+    for post in new_posts:
+        if post.in_reply_to_post_id:
+            adjust_reply_count(db, post.in_reply_to_post_id, 1)
+    db.commit()
+    return [post.id for post in new_posts]
+
+
+def apply_likes(db: Session, likes: Dict[Tuple[int, int], str]) -> List[LikeResult]:
+    """Apply coalesced like actions, keyed by (post_id, user_id), in one
+    transaction. Likes of posts that no longer exist are dropped."""
+    results = []
+    # Same lock order in every transaction, see change_likes
+    for (post_id, user_id), action in sorted(likes.items()):
+        result = apply_like(db, user_id, post_id, action)
+        if result is not None and result.changed:
+            results.append(result)
+    db.commit()
+    return results
+
+
+def in_session(fn, *args):
+    db = SessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+
+class WriteBehindWorker:
+    """Background task committing queued posts and likes in batches"""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.likes: Dict[Tuple[int, int], str] = {}
+        self.posts: List[Tuple[NewPost, asyncio.Future]] = []
+        self.arrived: Optional[asyncio.Event] = None
+        self.full: Optional[asyncio.Event] = None
+        self.stopping = False
+        self.batches = 0
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.stopping
+
+    def pending(self) -> int:
+        return len(self.likes) + len(self.posts)
+
+    def start(self) -> None:
+        self.arrived = asyncio.Event()
+        self.full = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self.run())
+
+    def queued(self) -> None:
+        self.arrived.set()
+        if self.pending() >= WRITE_BEHIND_BATCH_SIZE:
+            self.full.set()
+
+    def like(self, user_id: int, post_id: int, action: str) -> bool:
+        """Queue a like action. Returns False when the caller should write
+        it itself (not running, or too many writes waiting)"""
+        if not self.running or self.pending() >= WRITE_BEHIND_MAX_PENDING:
+            return False
+        key = (post_id, user_id)
+        combined = combine_like_actions(self.likes.get(key), action)
+        if combined is None:
+            del self.likes[key]
+        else:
+            self.likes[key] = combined
+        self.queued()
+        return True
+
+    async def create_post(self, post: NewPost) -> Optional[int]:
+        """Queue a post and wait until it is committed, return its id.
+
+        Returns None when the caller should write it itself.
+        """
+        if not self.running or self.pending() >= WRITE_BEHIND_MAX_PENDING:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.posts.append((post, future))
+        self.queued()
+        return await future
+
+    async def run(self) -> None:
+        while True:
+            await self.arrived.wait()
+            if not self.stopping:
+                # Give more writes the chance to join the batch
+                try:
+                    await asyncio.wait_for(self.full.wait(), WRITE_BEHIND_DELAY_MS / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+            if self.stopping and not self.pending():
+                return
+
+    async def flush(self) -> None:
+        self.arrived.clear()
+        self.full.clear()
+        likes, self.likes = self.likes, {}
+        posts, self.posts = self.posts, []
+        if posts:
+            await self.flush_posts(posts)
+        if likes:
+            await self.flush_likes(likes)
+        self.batches += 1
+
+    async def flush_posts(self, posts: List[Tuple[NewPost, asyncio.Future]]) -> None:
+        try:
+            ids = await run_in_threadpool(in_session, insert_posts, [post for post, _ in posts])
+        except Exception as error:
+            if len(posts) == 1:
+                if not posts[0][1].done():
+                    posts[0][1].set_exception(error)
+                return
+            # Retry one by one, so one bad post does not fail the others
+            for entry in posts:
+                await self.flush_posts([entry])
+            return
+        for (_, future), post_id in zip(posts, ids):
+            if not future.done():
+                future.set_result(post_id)
+
+    async def flush_likes(self, likes: Dict[Tuple[int, int], str]) -> None:
+        try:
+            results = await run_in_threadpool(in_session, apply_likes, likes)
+        except Exception:
+            if len(likes) == 1:
+                logger.exception("Applying like %s failed", likes)
+                return
+            for key, action in likes.items():
+                await self.flush_likes({key: action})
+            return
+        for result in results:
+            post_fragments.pop(result.post_id)
+        if results:
+            timeline_cache.bump("timelines")
+        for result in results:
+            await event_bus.publish("like_count", id=result.post_id, like_count=result.like_count)
+
+    async def stop(self) -> None:
+        """Commit everything queued and stop"""
+        if self.task is None:
+            return
+        self.stopping = True
+        self.arrived.set()
+        await self.task
+        self.task = None
+
+
+write_behind = WriteBehindWorker()
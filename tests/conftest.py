@@ -0,0 +1,100 @@
+# Settings are read when microblog is imported, so they are set here,
+# before any test module imports it. Tests always run against their own
+# SQLite file, never against DATABASE_URL from the environment.
+import os
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix="microblog-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DIR}/test.sqlite"
+os.environ["DATABASE_REPLICA_URLS"] = ""
+os.environ["CACHE_URL"] = "memory://"
+os.environ["SESSION_SECRET_KEY"] = "test"
+os.environ["TEMPLATE_BYTECODE_CACHE"] = "false"
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+import pytest  # noqa: E402
+
+
+def clear_caches() -> None:
+    from microblog.cache import timeline_cache
+    from microblog.routers.auth import verified_sessions
+    from microblog.template_utils import absolute_times, post_fragments
+
+    timeline_cache.values.clear()
+    timeline_cache.versions.clear()
+    for cache in (verified_sessions, post_fragments, absolute_times):
+        cache.clear()
+
+
+@pytest.fixture
+def engine():
+    """The app's engine, on an empty database"""
+    from microblog.database import engine
+    from microblog.models import Base
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    clear_caches()
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    from microblog.database import SessionLocal
+
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def client(engine):
+    """A client for the app, without running its startup"""
+    from fastapi.testclient import TestClient
+
+    from microblog.app import app
+
+    return TestClient(app)
+
+
+@pytest.fixture
+def add_user(db):
+    from microblog.models import User
+
+    def add_user(username: str):
+        user = User(username=username, email=f"{username}@example.com", hashed_password="-")
+        db.add(user)
+        db.commit()
+        return user
+
+    return add_user
+
+
+@pytest.fixture
+def add_post(db):
+    from microblog.counters import adjust_reply_count
+    from microblog.models import MicroblogPost
+
+    def add_post(author, content: str = "A post", reply_to=None):
+        post = MicroblogPost(author_id=author.id, content=content)
+        if reply_to is not None:
+            post.in_reply_to_post_id = reply_to.id
+            post.in_reply_to_user_id = reply_to.author_id
+            adjust_reply_count(db, reply_to.id, 1)
+        db.add(post)
+        db.commit()
+        return post
+
+    return add_post
+
+
+def log_in(client, user) -> None:
+    from microblog.routers.auth import create_session_token
+
+    client.cookies.set("session_token", create_session_token(user.id, user.username))
+
+
+@pytest.fixture
+def login():
+    return log_in
@@ -0,0 +1,75 @@
+# Likes changed concurrently must never be duplicated, and every post's
+# like_count must match its number of likes. benchmarks/likes_stress.py
+# runs the same check with more load, and against PostgreSQL.
+import random
+import threading
+
+from sqlalchemy import func, select
+
+THREADS = 8
+OPERATIONS = 100
+
+
+def hammer(users: list, posts: list, seed: int, errors: list) -> None:
+    from microblog.database import SessionLocal
+    from microblog.likes import ACTIONS, change_like, change_likes
+
+    rng = random.Random(seed)
+    db = SessionLocal()
+    try:
+        for _ in range(OPERATIONS):
+            user_id = rng.choice(users)
+            if rng.random() < 0.1:
+                change_likes(db, user_id, {rng.choice(posts): rng.random() < 0.5 for _ in range(3)})
+            else:
+                change_like(db, user_id, rng.choice(posts), rng.choice(ACTIONS))
+    except Exception as error:
+        errors.append(error)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def test_concurrent_likes_keep_counts(db, add_user, add_post):
+    from microblog.models import MicroblogPost, PostLike
+
+    author = add_user("author")
+    users = [add_user(f"user{i}").id for i in range(3)]
+    posts = [add_post(author).id for _ in range(3)]
+
+    errors = []
+    threads = [
+        threading.Thread(target=hammer, args=(users, posts, seed, errors))
+        for seed in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    db.expire_all()
+    duplicates = db.execute(
+        select(PostLike.post_id, PostLike.user_id)
+        .group_by(PostLike.post_id, PostLike.user_id)
+        .having(func.count() > 1)
+    ).all()
+    assert duplicates == []
+    for post in db.scalars(select(MicroblogPost)):
+        likes = db.scalar(select(func.count()).where(PostLike.post_id == post.id))
+        assert post.like_count == likes
+
+
+def test_like_and_unlike_are_idempotent(db, add_user, add_post):
+    from microblog.likes import LIKE, TOGGLE, UNLIKE, change_like
+
+    alice = add_user("alice")
+    post = add_post(alice)
+
+    assert change_like(db, alice.id, post.id, LIKE).changed
+    repeated = change_like(db, alice.id, post.id, LIKE)
+    assert (repeated.liked, repeated.like_count, repeated.changed) == (True, 1, False)
+    assert change_like(db, alice.id, post.id, TOGGLE).like_count == 0
+    repeated = change_like(db, alice.id, post.id, UNLIKE)
+    assert (repeated.liked, repeated.like_count, repeated.changed) == (False, 0, False)
+    assert change_like(db, alice.id, post.id + 1, LIKE) is None
@@ -0,0 +1,47 @@
+# Keyset pagination must return every post exactly once, including posts
+# created within the same second (or with the very same timestamp).
+from datetime import datetime
+
+import pytest
+
+
+def all_pages(load_page, limit: int) -> list:
+    ids, cursor = [], None
+    while True:
+        page, cursor = load_page(cursor, limit)
+        ids += [post.id for post in page]
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize("same_timestamp", [False, True])
+def test_timeline_pages(db, add_user, add_post, same_timestamp):
+    from microblog.fanout import load_global_timeline_page
+
+    alice = add_user("alice")
+    posts = [add_post(alice, f"Post {i}") for i in range(7)]
+    if same_timestamp:
+        for post in posts:
+            post.created_at = datetime(2024, 1, 1, 12)
+        db.commit()
+
+    ids = all_pages(lambda cursor, limit: load_global_timeline_page(db, cursor, limit), 2)
+    assert ids == [post.id for post in reversed(posts)]
+
+
+def test_reply_pages(db, add_user, add_post, monkeypatch):
+    from microblog import threads
+
+    monkeypatch.setattr(threads, "THREAD_MAX_CHILDREN", 2)
+    alice = add_user("alice")
+    root = add_post(alice, "Root")
+    replies = [add_post(alice, f"Reply {i}", reply_to=root) for i in range(5)]
+
+    ids, after = [], None
+    while True:
+        thread = threads.load_thread(db, root.id, alice.id, after)
+        ids += [node.post.id for node in thread.root.children]
+        if thread.root.more_replies_url is None:
+            break
+        after = thread.root.more_replies_url.split("after=")[1]
+    assert ids == [reply.id for reply in replies]
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import signal
+
+import pytest
+
+from microblog.passwords import PasswordHasher
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(workers=1, max_pending=4, rounds=4)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_hash_and_verify(hasher):
+    async def run():
+        hashed = await hasher.hash("secret")
+        return await hasher.verify("secret", hashed), await hasher.verify("wrong", hashed)
+
+    (matched, _), (wrong, _) = asyncio.run(run())
+    assert matched and not wrong
+
+
+def test_recovers_from_dead_worker(hasher):
+    asyncio.run(hasher.hash("secret"))
+    broken = hasher.executor
+    for process in list(broken._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+    hashed = asyncio.run(hasher.hash("secret"))
+    assert hasher.executor is not broken
+    matched, _ = asyncio.run(hasher.verify("secret", hashed))
+    assert matched
@@ -0,0 +1,51 @@
+# Pages must be rendered with a fixed number of SQL statements, however
+# many posts, replies and likes they show (no N+1 queries).
+import pytest
+from sqlalchemy import event
+
+from conftest import clear_caches
+
+
+def seed(add_user, add_post, db, posts: int):
+    from microblog.likes import LIKE, change_like
+
+    alice = add_user("alice")
+    bob = add_user("bob")
+    roots = [add_post(alice if i % 2 else bob, f"Post {i}") for i in range(posts)]
+    for i, root in enumerate(roots):
+        reply = add_post(bob, f"Reply {i}", reply_to=root)
+        add_post(alice, f"Reply to reply {i}", reply_to=reply)
+        change_like(db, bob.id, root.id, LIKE)
+        change_like(db, alice.id, root.id, LIKE)
+    return alice, roots[0]
+
+
+def count_statements(engine, client, url: str) -> int:
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    clear_caches()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize("url, expected", [
+    # The page, and which of its posts the viewer liked
+    ("/posts/", 2),
+    # The thread, and which of its posts the viewer liked
+    ("/posts/1", 2),
+    # The user, their page, and which of its posts the viewer liked
+    ("/users/alice", 3),
+])
+@pytest.mark.parametrize("posts", [1, 10, 40])
+def test_page_query_count(engine, db, client, add_user, add_post, login, posts, url, expected):
+    alice, _ = seed(add_user, add_post, db, posts)
+    login(client, alice)
+    assert count_statements(engine, client, url) == expected
@@ -0,0 +1,118 @@
+# The hot queries must be answered from the indexes added by migration
+# 83557711435d, not by scanning a table.
+#
+# The statements are captured while the routers' loaders run against the
+# test database, then explained (EXPLAIN QUERY PLAN) on a database built
+# by the migrations, so the indexes checked are the ones deployments get.
+import os
+import re
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event
+
+from conftest import TEST_DIR
+
+ALEMBIC_INI = os.path.join(os.path.dirname(__file__), "..", "src", "alembic.ini")
+TABLES = ("microblog_posts", "microblog_likes", "users")
+
+
+@pytest.fixture
+def migrated(monkeypatch):
+    """An engine on an empty database built by `alembic upgrade head`"""
+    path = os.path.join(TEST_DIR, "migrated.sqlite")
+    if os.path.exists(path):
+        os.remove(path)
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{path}")
+    command.upgrade(Config(ALEMBIC_INI), "head")
+    migrated = create_engine(f"sqlite:///{path}")
+    yield migrated
+    migrated.dispose()
+
+
+@pytest.fixture
+def thread(db, add_user, add_post):
+    from microblog.likes import LIKE, change_like
+
+    alice = add_user("alice")
+    bob = add_user("bob")
+    posts = [add_post(alice, f"Post {i}") for i in range(5)]
+    reply = add_post(bob, "Reply", reply_to=posts[0])
+    add_post(alice, "Reply to reply", reply_to=reply)
+    change_like(db, bob.id, posts[0].id, LIKE)
+    return alice, bob, posts[0]
+
+
+def query_plans(engine, migrated, load) -> list:
+    """The plan of every statement `load()` runs, one list of steps each"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        load()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    with migrated.connect() as connection:
+        return [
+            [
+                row[3] for row in
+                connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            ]
+            for statement, parameters in statements
+        ]
+
+
+def assert_uses_index(plans: list, index: str) -> None:
+    steps = [step for plan in plans for step in plan]
+    assert any(index in step for step in steps), steps
+    # "SCAN <table>" without "USING ... INDEX" reads the whole table
+    full_scans = [
+        step for step in steps
+        if re.fullmatch(rf"SCAN (?:{'|'.join(TABLES)})(?:_\d+)?", step)
+    ]
+    assert not full_scans, steps
+
+
+@pytest.mark.parametrize("before", [False, True])
+def test_timeline_uses_timeline_index(engine, db, migrated, thread, before):
+    from microblog.fanout import load_global_timeline_page
+
+    cursor = load_global_timeline_page(db, None, 2)[1] if before else None
+    plans = query_plans(engine, migrated, lambda: load_global_timeline_page(db, cursor, 2))
+    assert_uses_index(plans, "ix_microblog_posts_timeline")
+
+
+def test_profile_uses_author_index(engine, db, migrated, thread):
+    from microblog.routers.users import load_users_page
+
+    alice, bob, _ = thread
+    plans = query_plans(
+        engine, migrated, lambda: load_users_page(db, "alice", bob.id, None, 2)
+    )
+    assert_uses_index(plans, "ix_microblog_posts_author_id_created_at")
+
+
+def test_replies_use_reply_index(engine, db, migrated, thread):
+    from microblog.threads import load_thread
+
+    alice, _, root = thread
+    plans = query_plans(engine, migrated, lambda: load_thread(db, root.id, alice.id))
+    assert_uses_index(plans, "ix_microblog_posts_in_reply_to_post_id")
+
+
+def test_likes_use_like_index(engine, db, migrated, thread):
+    from microblog.likes import UNLIKE, change_like
+    from microblog.timeline import fetch_posts, timeline_query, with_liked
+
+    alice, bob, root = thread
+    page = fetch_posts(timeline_query(db))
+    plans = query_plans(engine, migrated, lambda: with_liked(db, page, bob.id))
+    assert_uses_index(plans, "uq_microblog_likes_post_id_user_id")
+
+    plans = query_plans(engine, migrated, lambda: change_like(db, bob.id, root.id, UNLIKE))
+    assert_uses_index(plans, "uq_microblog_likes_post_id_user_id")
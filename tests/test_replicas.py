@@ -0,0 +1,89 @@
+# Read replica routing, with two SQLite files standing in for a primary
+# and a replica that has not caught up (nothing is replicated to it).
+import os
+import time
+
+import pytest
+
+from conftest import TEST_DIR
+
+
+@pytest.fixture
+def replica(engine, monkeypatch):
+    """A replica with the schema and users of the primary, but no posts"""
+    from microblog import database
+    from microblog.models import Base
+
+    path = os.path.join(TEST_DIR, "replica.sqlite")
+    if os.path.exists(path):
+        os.remove(path)
+    pool = database.ReplicaPool([f"sqlite:///{path}"])
+    Base.metadata.create_all(pool.replicas[0].engine)
+    monkeypatch.setattr(database, "replica_pool", pool)
+    yield pool.replicas[0]
+    pool.replicas[0].engine.dispose()
+
+
+@pytest.fixture
+def sticky_client(engine):
+    """A client for the app with StickyPrimaryMiddleware, as installed
+    when DATABASE_REPLICA_URLS is set"""
+    from fastapi.testclient import TestClient
+
+    from microblog.app import app
+    from microblog.database import StickyPrimaryMiddleware
+
+    return TestClient(StickyPrimaryMiddleware(app))
+
+
+def copy_users(engine, replica) -> None:
+    from microblog.models import User
+
+    with engine.connect() as primary, replica.engine.begin() as copy:
+        rows = [row._asdict() for row in primary.execute(User.__table__.select())]
+        copy.execute(User.__table__.insert(), rows)
+
+
+def test_reads_go_to_the_replica(engine, client, replica, add_user, add_post):
+    alice = add_user("alice")
+    add_post(alice, "Only on the primary")
+
+    assert "Only on the primary" not in client.get("/posts/").text
+    assert "Only on the primary" not in client.get("/users/alice").text
+
+
+def test_unhealthy_replica_falls_back_to_primary(engine, client, replica, add_user, add_post):
+    alice = add_user("alice")
+    add_post(alice, "Only on the primary")
+
+    replica.healthy = False
+    assert "Only on the primary" in client.get("/posts/").text
+
+
+def test_writer_reads_own_writes(engine, sticky_client, client, replica, add_user, login):
+    alice = add_user("alice")
+    copy_users(engine, replica)
+    login(sticky_client, alice)
+
+    response = sticky_client.post(
+        "/posts/create", data={"content": "Fresh post"}, follow_redirects=False
+    )
+    assert response.status_code == 303
+    assert float(sticky_client.cookies["read_primary"]) > time.time()
+
+    # Someone else reads the front page and the author's page from the
+    # lagging replica right after the write...
+    assert "Fresh post" not in client.get("/posts/").text
+    assert "Fresh post" not in client.get("/users/alice").text
+    # ...which must not end up in the cache the writer reads from
+    assert "Fresh post" in sticky_client.get("/posts/").text
+    assert "Fresh post" in sticky_client.get("/users/alice").text
+
+
+def test_sticky_cookie_only_after_writes(engine, sticky_client, replica):
+    sticky_client.get("/posts/")
+    assert "read_primary" not in sticky_client.cookies
+
+    response = sticky_client.post("/posts/create", data={"content": "No login"})
+    assert response.status_code == 401
+    assert "read_primary" not in sticky_client.cookies
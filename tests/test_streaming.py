@@ -0,0 +1,48 @@
+import importlib
+import re
+
+import anyio
+import anyio.to_thread
+import pytest
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    # microblog.routers.posts is shadowed by the router of the same name
+    posts = importlib.import_module("microblog.routers.posts")
+    monkeypatch.setattr(posts, "STREAMING_RENDER", True)
+
+
+def test_streamed_pages(engine, client, streaming, add_user, add_post):
+    alice = add_user("alice")
+    for i in range(5):
+        add_post(alice, f"Post number {i}")
+
+    page = client.get("/posts/?limit=3").text
+    assert re.findall(r"Post number \d", page) == ["Post number 4", "Post number 3", "Post number 2"]
+    next_page = re.search(r'href="([^"]*before=[^"]*)"', page).group(1).replace("&amp;", "&")
+    page = client.get(next_page).text
+    assert re.findall(r"Post number \d", page) == ["Post number 1", "Post number 0"]
+    assert "before=" not in page
+
+
+def test_slow_client_holds_no_threadpool_token(monkeypatch):
+    from microblog import template_utils
+
+    template = template_utils.templates.env.from_string("{% for i in items %}{{ i }}{% endfor %}")
+    monkeypatch.setattr(template_utils.templates, "get_template", lambda name: template)
+    monkeypatch.setattr(template_utils, "STREAM_QUEUE_SIZE", 1)
+
+    async def run():
+        response = template_utils.stream_template("test", {"items": range(100000)})
+        chunks = response.body_iterator
+        await chunks.__anext__()
+        # The client stops reading: only the renderer holds a thread
+        assert anyio.to_thread.current_default_thread_limiter().borrowed_tokens == 0
+        assert template_utils.stream_renderers.borrowed_tokens == 1
+        await chunks.aclose()
+        with anyio.fail_after(5):
+            while template_utils.stream_renderers.borrowed_tokens:
+                await anyio.sleep(0.01)
+
+    anyio.run(run)